@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from synthetic_logs import generate_tree
+
+# Throughput and peak memory of each post-processing stage on synthetic log
+# trees of increasing size. Every stage runs in a fresh interpreter so its
+# peak RSS is its own; stages run in pipeline order on the same tree:
+#   rename -> catalog -> statistics -> merge
+# Results can be saved and compared with an earlier run to catch regressions.
+
+default_sizes = [100, 1000, 10000]
+
+
+def tree_size(directories):
+    files = 0
+    size = 0
+    for directory in directories:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('log.json'):
+                    files += 1
+                    size += entry.stat().st_size
+    return files, size
+
+
+def stage_rename(workdir, directories, jobs):
+    from rename_log import correct_and_rename_logs
+    from correct_log_5 import resolve_double_four_log_issue
+    for directory in directories:
+        correct_and_rename_logs(directory)
+        resolve_double_four_log_issue(directory)
+
+
+def stage_catalog(workdir, directories, jobs):
+    from log_catalog import open_catalog, update_catalog
+    update_catalog(open_catalog(os.path.join(workdir, 'log_catalog.sqlite')), directories, jobs)
+
+
+def stage_statistics(workdir, directories, jobs):
+    from log_catalog import open_catalog, update_catalog
+    from log_statistics import find_unique_users, count_users_in_logs
+    catalog = open_catalog(os.path.join(workdir, 'log_catalog.sqlite'))
+    update_catalog(catalog, directories, jobs)
+    find_unique_users(directories, os.path.join(workdir, 'duplicate_usernames.txt'), catalog)
+    count_users_in_logs(directories, os.path.join(workdir, 'log_statistics.csv'),
+                        os.path.join(workdir, 'speaking_stats.txt'), catalog)
+
+
+def stage_merge(workdir, directories, jobs):
+    from log_catalog import open_catalog
+    from merge_log import process_directories, make_sure_path_exists
+    output_dir = os.path.join(workdir, 'full_logs')
+    make_sure_path_exists(output_dir)
+    process_directories(directories, output_dir, [], os.path.join(workdir, 'log_counts.txt'),
+                        open_catalog(os.path.join(workdir, 'log_catalog.sqlite')), jobs)
+
+
+stages = [
+    ('rename', stage_rename),
+    ('catalog', stage_catalog),
+    ('statistics', stage_statistics),
+    ('merge', stage_merge),
+]
+
+
+def run_stage(name, workdir, directories, jobs, results):
+    # Runs in a spawned process; the scripts' progress output is dropped
+    sys.stdout = open(os.devnull, 'w')
+    from instrumentation import current
+    started = time.perf_counter()
+    dict(stages)[name](workdir, directories, jobs)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux; worker processes of --jobs are included
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # The stage timings and counters the scripts recorded (see instrumentation)
+    metrics = current().as_dict()
+    results.put((elapsed, peak / 1024.0, metrics['stages'], metrics['counters']))
+
+
+def measure(name, workdir, directories, jobs):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(name, workdir, directories, jobs, results))
+    process.start()
+    measured = results.get()
+    process.join()
+    return measured
+
+
+def benchmark(sizes, workdir, jobs=1, rooms_per_directory=100, seed=0):
+    results = []
+    for rooms in sizes:
+        tree = os.path.join(workdir, 'rooms_{}'.format(rooms))
+        if os.path.isdir(tree):
+            shutil.rmtree(tree)
+        directories = generate_tree(tree, rooms, rooms_per_directory, raw=True, seed=seed)
+        for name, _ in stages:
+            # Sizes are taken before each stage, as rename changes the file names
+            files, size = tree_size(directories)
+            elapsed, peak_rss, substages, counters = measure(name, tree, directories, jobs)
+            results.append({
+                'stage': name,
+                'rooms': rooms,
+                'files': files,
+                'megabytes': size / 1e6,
+                'seconds': elapsed,
+                'files_per_second': files / elapsed if elapsed else None,
+                'megabytes_per_second': size / 1e6 / elapsed if elapsed else None,
+                'peak_rss_megabytes': peak_rss,
+                'substages': substages,
+                'counters': counters,
+            })
+            print("{:>10} {:>6} rooms: {:8.2f}s {:10.1f} files/s {:8.2f} MB/s {:8.1f} MB peak RSS".format(
+                name, rooms, elapsed, results[-1]['files_per_second'] or 0,
+                results[-1]['megabytes_per_second'] or 0, peak_rss))
+        shutil.rmtree(tree)
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    # Stages that are slower, or need more memory, than the baseline by more than threshold
+    previous = dict(((row['stage'], row['rooms']), row) for row in baseline)
+    regressions = []
+    for row in results:
+        before = previous.get((row['stage'], row['rooms']))
+        if before is None:
+            continue
+        for metric in ('seconds', 'peak_rss_megabytes'):
+            if before[metric] and row[metric] > before[metric] * threshold:
+                regressions.append("{} at {} rooms: {} {:.2f} -> {:.2f}".format(
+                    row['stage'], row['rooms'], metric, before[metric], row[metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the post-processing stages on synthetic logs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help="numbers of rooms to test")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes for the stages")
+    parser.add_argument('--workdir', help="directory for the generated logs (default: a temporary directory)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='post_process_benchmark_')
+    results = benchmark(args.sizes, workdir, args.jobs)
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
@@ -1,56 +1,91 @@
 import os
-from datetime import datetime
+import argparse
+from rename_plan import run_plan, rollback
+from log_names import parse_log_filename
+from log_pairing import default_max_delta
+from instrumentation import stage, count, add_arguments, instrumented
 
-def resolve_double_four_log_issue(directory):
-    # This dictionary will hold the file paths grouped by room and date only (without specific times)
-    log_groups = {}
+# Longest time between the two log 4 files of one session
+session_gap = default_max_delta
+
+def landed_sessions(filenames):
+    # (spec, time) of the log 4 files among the given names; rename_log keeps both
+    # in the new name, so raw names just written by the server can be given
+    landed = set()
+    for filename in filenames:
+        name_info = parse_log_filename(filename)
+        if name_info is not None and name_info.version == 4:
+            landed.add((name_info.spec, name_info.time))
+    return landed
+
+def plan_log_5_renames(plan, directory, landed=None):
+    # landed: (spec, time) of the log 4 files to pair; None pairs every log 4 of the directory
+    # This dictionary will hold the log 4 and log 5 files of each room, whatever their date
+    room_logs = {}
 
-    # Check if the directory exists
-    if not os.path.exists(directory):
-        print("Directory does not exist:", directory)
-        return
-    
     # Check if the directory is empty
-    if not os.listdir(directory):
+    filenames = plan.listdir(directory)
+    if not filenames:
         print("Directory is empty.")
         return
 
     # Scan through the directory containing the logs
-    for filename in os.listdir(directory):
-        if filename.startswith("pilot_study_") and filename.endswith("_log.json"):
-            print("Found log file:", filename)
-            parts = filename.split('_')
-            room_id = parts[2]
-            date = parts[3]
-            room_date_key = '_'.join(parts[:4])  # should use room and date (without the exact time)
-            room_date_key = room_date_key.rsplit('-', 1)[0]  # Remove the time part
-            
-            # Collect files under the same room and date
-            if room_date_key not in log_groups:
-                log_groups[room_date_key] = []
-            log_groups[room_date_key].append(filename)
-
-    print("Total groups found:", len(log_groups))
-
-    # Process each group to find and rename the late "4_log"
-    for key, files in log_groups.items():
-        print("Processing group:", key, "with", len(files), "files")
-        # Filter to get only those ending with "4_log.json"
-        four_logs = [f for f in files if f.endswith("_4_log.json")]
-        if len(four_logs) == 2:
-            print("Two 4_log files found in group:", key)
-            # Sort based on the timestamp in the filename
-            four_logs_sorted = sorted(four_logs, key=lambda x: datetime.strptime(x.split('_')[3], "%d.%m.%Y-%H.%M"))
+    for filename in filenames:
+        name_info = parse_log_filename(filename)
+        if (name_info is not None and name_info.kind == 'log' and name_info.spec.startswith("pilot_study_")
+                and name_info.version in (4, 5)):
+            if name_info.spec not in room_logs:
+                room_logs[name_info.spec] = []
+            room_logs[name_info.spec].append((name_info.time, name_info.version, filename))
+
+    # A room can run several times a day, so its logs are split into sessions: the
+    # log 4 written at the end of a session and the one written a minute later are
+    # at most session_gap apart, while the next session starts after both
+    for spec, files in room_logs.items():
+        files.sort()
+        sessions = []
+        for log_time, version, filename in files:
+            if sessions and len(sessions[-1]) == 1 and log_time - sessions[-1][0][0] <= session_gap:
+                sessions[-1].append((log_time, version, filename))
+            else:
+                sessions.append([(log_time, version, filename)])
+        count('log_sessions', len(sessions))
+
+        # Process each session to find and rename the late "4_log"
+        for session in sessions:
+            if len(session) != 2 or session[0][1] != 4 or session[1][1] != 4:
+                # Already corrected, or a single log 4
+                if [version for _, version, _ in session] != [4, 5]:
+                    count('irregular_log4_sessions')
+                continue
+            if landed is not None and not any((spec, log_time) in landed for log_time, _, _ in session):
+                continue
+            count('double_log4_sessions')
             # The later file needs to be renamed to "_5_log.json"
-            old_name = four_logs_sorted[1]
+            old_name = session[1][2]
             new_name = old_name.replace("_4_log.json", "_5_log.json")
-            os.rename(os.path.join(directory, old_name), os.path.join(directory, new_name))
-            print("Renamed:", old_name, "to", new_name)
-        elif len(four_logs) == 1:
-            print("Only one 4_log file found in group:", key)
-        else:
-            print("No 4_log file or more than two found in group:", key)
+            plan.add(os.path.join(directory, old_name), os.path.join(directory, new_name))
+
+def resolve_double_four_log_issue(directory, dry_run=False, filenames=None):
+    # filenames: names of logs that just landed, whose sessions alone are paired
+    landed = landed_sessions(filenames) if filenames is not None else None
+    with stage('rename'):
+        operations = run_plan(directory, 'correct_log_5',
+                              lambda plan, directory: plan_log_5_renames(plan, directory, landed), dry_run)
+    if not dry_run:
+        count('files_renamed', len(operations))
+    return operations
 
-# Example usage
-log_directory = '/srv/chat-room/chat-room.git/chatlog_07_23'
-resolve_double_four_log_issue(log_directory)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rename the later of two log 4 files of a session to log 5.")
+    parser.add_argument('directory', nargs='?', default='/srv/chat-room/chat-room.git/chatlog_07_23')
+    parser.add_argument('--dry-run', action='store_true', help="print the planned renames without renaming")
+    parser.add_argument('--rollback', action='store_true', help="undo the renames of the last run")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args, 'correct_log_5'):
+        if args.rollback:
+            rollback(args.directory, 'correct_log_5')
+        else:
+            resolve_double_four_log_issue(args.directory, args.dry_run)
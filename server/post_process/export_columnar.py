@@ -0,0 +1,162 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from log_catalog import default_catalog_path, open_catalog, update_catalog, iter_logs
+from log_reader import iter_log, parse_log_time
+from async_io import bounded_map, add_arguments as add_io_arguments
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+# Flattens chat logs into three column tables so analysis can run as array
+# operations instead of walking and re-parsing nested JSON:
+#   comments  one row per comment or reply of every log
+#   users     one row per user listed in every log
+#   rooms     one row per log file
+# log_index in comments and users is the row of the log in rooms.
+# Tables are written as Parquet when pyarrow is installed, as .npz otherwise.
+
+# parent_id of top-level comments; user comment ids start at 1 and bot ids at -1
+top_level_parent = 0
+
+table_columns = {
+    'comments': ['log_index', 'room_id', 'spec', 'session_start', 'log_version', 'comment_id', 'parent_id',
+                 'depth', 'user_name', 'bot', 'time_offset', 'content_length'],
+    'users': ['log_index', 'room_id', 'spec', 'session_start', 'log_version', 'name', 'prolific_pid',
+              'session_id', 'study_id'],
+    'rooms': ['log_index', 'room_id', 'spec', 'session_start', 'log_version', 'file_timestamp', 'bot_type',
+              'duration', 'num_users', 'num_comments', 'path'],
+}
+
+column_types = {
+    'log_index': np.int64, 'room_id': np.int64, 'log_version': np.int64, 'comment_id': np.int64,
+    'parent_id': np.int64, 'depth': np.int64, 'bot': np.bool_, 'time_offset': np.float64,
+    'content_length': np.int64, 'duration': np.float64, 'num_users': np.int64, 'num_comments': np.int64,
+}
+
+
+def flatten_log(log_index, path, room_id, spec, file_timestamp, log_version):
+    tables = dict((name, dict((column, []) for column in columns)) for name, columns in table_columns.items())
+    fields = {}
+    users = []
+    comments = []
+
+    with open(path, 'r') as file:
+        for key, value in iter_log(file):
+            if key == 'users':
+                users.append(value)
+            elif key == 'comments':
+                comments.append(value)
+            else:
+                fields[key] = value
+
+    # Every row carries the session key; startTime is only known once the log is read
+    room = [log_index, room_id if room_id is not None else -1, spec, fields.get('startTime') or '', log_version]
+    start = parse_log_time(fields.get('startTime'))
+
+    def add_row(table, values):
+        for column, value in zip(table_columns[table], room + values):
+            tables[table][column].append(value)
+
+    def add_comment(comment, parent_id, depth):
+        time = parse_log_time(comment.get('time'))
+        offset = (time - start).total_seconds() if time and start else np.nan
+        add_row('comments', [comment.get('id') or 0, parent_id, depth, comment.get('userName') or '',
+                             bool(comment.get('bot')), offset, len(comment.get('content') or '')])
+        for reply in comment.get('replies') or []:
+            add_comment(reply, comment.get('id'), depth + 1)
+
+    for user in users:
+        add_row('users', [user.get('name') or '', user.get('prolificPid') or '', user.get('sessionId') or '',
+                          user.get('studyId') or ''])
+    for comment in comments:
+        add_comment(comment, top_level_parent, 0)
+
+    add_row('rooms', [file_timestamp, fields.get('botType') or '',
+                      fields.get('duration') if fields.get('duration') is not None else np.nan,
+                      len(users), len(comments), path])
+    return tables
+
+
+def flatten_task(task):
+    return flatten_log(*task)
+
+
+def to_arrays(columns):
+    arrays = {}
+    for column, values in columns.items():
+        if column in column_types:
+            arrays[column] = np.array(values, dtype=column_types[column])
+        else:
+            arrays[column] = np.array(values, dtype=str)
+    return arrays
+
+
+def build_tables(catalog, directories, versions=None, jobs=1, io_concurrency=0):
+    tasks = []
+    for directory in directories:
+        for log in iter_logs(catalog, [directory], versions=versions, recursive=True):
+            tasks.append((len(tasks), log['path'], log['room_id'], log['spec'], log['timestamp'], log['version']))
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            parts = list(executor.map(flatten_task, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    else:
+        parts = bounded_map(flatten_task, tasks, io_concurrency)
+
+    tables = {}
+    for name, columns in table_columns.items():
+        merged = dict((column, []) for column in columns)
+        for part in parts:
+            for column in columns:
+                merged[column].extend(part[name][column])
+        tables[name] = to_arrays(merged)
+    return tables
+
+
+def write_tables(tables, output_dir):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for name, arrays in tables.items():
+        if pyarrow is not None:
+            table = pyarrow.table(dict((column, arrays[column]) for column in table_columns[name]))
+            parquet.write_table(table, os.path.join(output_dir, name + '.parquet'))
+        else:
+            np.savez(os.path.join(output_dir, name + '.npz'), **arrays)
+
+
+def load_table(output_dir, name):
+    # Returns {column: numpy array} from whichever format export wrote
+    parquet_path = os.path.join(output_dir, name + '.parquet')
+    if os.path.exists(parquet_path):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to read {}".format(parquet_path))
+        table = parquet.read_table(parquet_path)
+        return dict((column, table.column(column).to_numpy(zero_copy_only=False)) for column in table.column_names)
+    with np.load(os.path.join(output_dir, name + '.npz')) as data:
+        return dict((column, data[column]) for column in data.files)
+
+
+def load_tables(output_dir):
+    return dict((name, load_table(output_dir, name)) for name in table_columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export chat logs as comment/user/room column tables.")
+    parser.add_argument('directories', nargs='+', help="chatlog directories to export")
+    parser.add_argument('--output', default='/srv/chat-room/chat-room.git/columnar/')
+    parser.add_argument('--versions', type=int, nargs='*', help="log versions to export (default: all)")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes")
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    update_catalog(catalog, args.directories, args.jobs, args.io_concurrency)
+    tables = build_tables(catalog, args.directories, args.versions, args.jobs, args.io_concurrency)
+    write_tables(tables, args.output)
+    print("Exported {} comments, {} users and {} logs to {}".format(
+        len(tables['comments']['comment_id']), len(tables['users']['name']), len(tables['rooms']['path']), args.output))
@@ -0,0 +1,232 @@
+import os
+import json
+import shutil
+import sqlite3
+import zipfile
+import argparse
+from datetime import timedelta
+from log_catalog import scan_directory, catalog_directory, subdirectory_condition
+from log_names import parse_response_filename, parse_timestamp
+
+# Index of the GPT responses written by saveGPTResponses in gpt.ts. Every
+# response file is recorded once with its room, session and version, so the
+# final responses can be looked up and exported without walking, renaming or
+# moving the response directory. Later runs only read new or changed files.
+
+default_archive_path = '/srv/chat-room/chat-room.git/gpt_archive.sqlite'
+
+# Minutes after the room start at which each response version is written (GPT is called at 02:03, 05:03, 08:03)
+version_minutes = {1: 2, 2: 5, 3: 8}
+# The last version, which repeats the earlier ones; only it is exported as the full response
+full_version = 3
+# Responses whose estimated room starts lie this close together belong to one session
+session_tolerance = timedelta(minutes=2)
+
+# Bump when the schema below changes
+archive_version = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS gpt_responses (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    room_id INTEGER,
+    timestamp TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    session_start TEXT,
+    selected_argument TEXT,
+    responses TEXT
+);
+CREATE INDEX IF NOT EXISTS gpt_responses_session ON gpt_responses (spec, session_start, version);
+CREATE INDEX IF NOT EXISTS gpt_responses_room ON gpt_responses (room_id, session_start);
+"""
+
+
+def open_archive(archive_path=default_archive_path):
+    conn = sqlite3.connect(archive_path)
+    conn.row_factory = sqlite3.Row
+    # The index is a cache of the response files, so an outdated layout is simply rebuilt
+    if conn.execute("PRAGMA user_version").fetchone()[0] != archive_version:
+        conn.execute("DROP TABLE IF EXISTS gpt_responses")
+        conn.execute("PRAGMA user_version = {}".format(archive_version))
+    conn.executescript(schema)
+    return conn
+
+
+def read_response(path, version):
+    try:
+        with open(path, 'r') as f:
+            responses = json.load(f)
+    except ValueError:
+        return None, None
+    return json.dumps(responses), responses.get('selected_missing_argument_for_log_{}'.format(version))
+
+
+def estimated_start(timestamp, version):
+    return parse_timestamp(timestamp) - timedelta(minutes=version_minutes.get(version, 0))
+
+
+def assign_sessions(conn, specs):
+    # A room session is the run of responses of one spec whose estimated room starts
+    # are close together; it is named after the earliest of them
+    for spec in specs:
+        rows = conn.execute("SELECT path, timestamp, version FROM gpt_responses WHERE spec = ?", (spec,)).fetchall()
+        entries = sorted((estimated_start(row['timestamp'], row['version']), row['path']) for row in rows)
+        session_start = None
+        previous = None
+        for start, path in entries:
+            if previous is None or start - previous > session_tolerance:
+                session_start = start
+            previous = start
+            conn.execute("UPDATE gpt_responses SET session_start = ? WHERE path = ?", (str(session_start), path))
+
+
+def update_archive(conn, directories):
+    summary = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    changed_specs = set()
+
+    for directory in directories:
+        directory = catalog_directory(directory)
+        known = {}
+        below, below_params = subdirectory_condition('directory', directory)
+        for row in conn.execute(
+                "SELECT path, spec, size, mtime FROM gpt_responses WHERE directory = ? OR " + below,
+                [directory] + below_params):
+            known[row['path']] = (row['spec'], row['size'], row['mtime'])
+
+        for path, parent, filename, stat in scan_directory(directory, '.json'):
+            name_info = parse_response_filename(filename)
+            if name_info is None:
+                continue
+            previous = known.pop(path, None)
+            if previous is not None and previous[1:] == (stat.st_size, stat.st_mtime):
+                summary['unchanged'] += 1
+                continue
+            summary['added' if previous is None else 'updated'] += 1
+            responses, selected_argument = read_response(path, name_info.version)
+            conn.execute(
+                "INSERT OR REPLACE INTO gpt_responses (path, directory, filename, spec, room_id, timestamp, version, "
+                "size, mtime, selected_argument, responses) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, parent, filename, name_info.spec, name_info.room_id, name_info.timestamp,
+                 name_info.version, stat.st_size, stat.st_mtime, selected_argument, responses)
+            )
+            changed_specs.add(name_info.spec)
+
+        # Files that disappeared since the last scan
+        for path, (spec, _, _) in known.items():
+            conn.execute("DELETE FROM gpt_responses WHERE path = ?", (path,))
+            changed_specs.add(spec)
+            summary['removed'] += 1
+
+    assign_sessions(conn, changed_specs)
+    conn.commit()
+    return summary
+
+
+def room_filter(room):
+    # A room is given by its spec (pilot_study_5, pilot_study_5.json) or its number
+    if isinstance(room, int) or str(room).isdigit():
+        return "room_id = ?", int(room)
+    return "spec = ?", str(room)[:-len('.json')] if str(room).endswith('.json') else str(room)
+
+
+def room_sessions(conn, room):
+    where, param = room_filter(room)
+    return [row['session_start'] for row in conn.execute(
+        "SELECT DISTINCT session_start FROM gpt_responses WHERE " + where + " ORDER BY session_start", (param,))]
+
+
+def final_response(conn, room, session_start):
+    # The response of the highest version of the session; each version repeats the earlier ones
+    where, param = room_filter(room)
+    return conn.execute(
+        "SELECT * FROM gpt_responses WHERE " + where + " AND session_start = ? "
+        "ORDER BY version DESC, timestamp DESC LIMIT 1", (param, str(session_start))
+    ).fetchone()
+
+
+def iter_final_responses(conn):
+    return conn.execute("SELECT * FROM gpt_responses WHERE version = ? ORDER BY spec, session_start, path",
+                        (full_version,))
+
+
+def partial_sessions(conn):
+    # [(spec, session_start, highest version)] of the sessions without a full response
+    return [(row['spec'], row['session_start'], row['version']) for row in conn.execute(
+        "SELECT spec, session_start, MAX(version) AS version FROM gpt_responses GROUP BY spec, session_start "
+        "HAVING MAX(version = ?) = 0 ORDER BY spec, session_start", (full_version,))]
+
+
+def report_partial_sessions(conn):
+    sessions = partial_sessions(conn)
+    if sessions:
+        print("{} sessions have no v{} response and were not exported:".format(len(sessions), full_version))
+        for spec, session_start, version in sessions:
+            print("  {} {} (up to v{})".format(spec, session_start, version))
+    return sessions
+
+
+def load_responses(row):
+    return json.loads(row['responses']) if row['responses'] is not None else None
+
+
+def final_filename(row):
+    # The name select_gptresponse used for the full (v3) response of a session
+    return row['filename'].replace(':', '.').replace('v{}'.format(full_version), 'full')
+
+
+def link_final_responses(conn, destination):
+    # Hard links keep a single copy on disk; copies are made across file systems
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    linked = 0
+    for row in iter_final_responses(conn):
+        target = os.path.join(destination, final_filename(row))
+        if os.path.exists(target):
+            if os.path.samefile(row['path'], target):
+                continue
+            os.remove(target)
+        try:
+            os.link(row['path'], target)
+        except OSError:
+            shutil.copy2(row['path'], target)
+        linked += 1
+    return linked
+
+
+def pack_final_responses(conn, archive_file):
+    count = 0
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for row in iter_final_responses(conn):
+            archive.write(row['path'], final_filename(row))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index GPT responses and export the final response of each session.")
+    parser.add_argument('directories', nargs='*', default=['/srv/chat-room/server/private/gptResponses'])
+    parser.add_argument('--link', help="hard link the final responses into this directory")
+    parser.add_argument('--archive', help="pack the final responses into this zip file")
+    parser.add_argument('--room', help="print the final responses of this room (spec or number)")
+    parser.add_argument('--session', help="with --room, only the session starting at this time")
+    args = parser.parse_args()
+
+    conn = open_archive(default_archive_path)
+    print("Indexed GPT responses: {}".format(update_archive(conn, args.directories)))
+
+    if args.link:
+        print("Linked {} final responses into {}".format(link_final_responses(conn, args.link), args.link))
+    if args.archive:
+        print("Packed {} final responses into {}".format(pack_final_responses(conn, args.archive), args.archive))
+    if args.link or args.archive:
+        report_partial_sessions(conn)
+    if args.room:
+        for session_start in [args.session] if args.session else room_sessions(conn, args.room):
+            row = final_response(conn, args.room, session_start)
+            print(json.dumps({'session_start': session_start, 'file': row['path'] if row else None,
+                              'version': row['version'] if row else None,
+                              'responses': load_responses(row) if row else None}, indent=2))
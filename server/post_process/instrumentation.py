@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Where the post_process scripts spend their time. Code marks its stages with
+# `with stage('parse'):` and counts what it handles with count('files'); the
+# scripts report the totals and the peak memory at the end of a run, as a short
+# summary and, with --metrics, as JSON. Stages may nest and their times are
+# inclusive. Work done in worker processes is collected with collect() and
+# merged into the metrics of the parent; stages may also run in the threads of
+# --io-concurrency, so updates are locked. --profile adds a cProfile (or
+# pyinstrument) profile of the whole run.
+
+
+def peak_rss_megabytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS; worker processes count once they exited
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        # name -> {'seconds', 'calls', 'peak_rss_megabytes' when the stage last ended}
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, name, seconds, calls=1, peak_rss=None):
+        if peak_rss is None:
+            peak_rss = peak_rss_megabytes()
+        with self.lock:
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_megabytes': 0.0})
+            entry['seconds'] += seconds
+            entry['calls'] += calls
+            entry['peak_rss_megabytes'] = max(entry['peak_rss_megabytes'], peak_rss)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, data):
+        # Adds the metrics of another process, as returned by as_dict
+        for name, entry in data['stages'].items():
+            self.add_time(name, entry['seconds'], entry['calls'], entry['peak_rss_megabytes'])
+        for name, value in data['counters'].items():
+            self.count(name, value)
+
+    def as_dict(self):
+        with self.lock:
+            stages = dict((name, dict(entry)) for name, entry in self.stages.items())
+            counters = dict(self.counters)
+        return {
+            'seconds': time.perf_counter() - self.started,
+            'peak_rss_megabytes': peak_rss_megabytes(),
+            'stages': stages,
+            'counters': counters,
+        }
+
+    def summary(self):
+        data = self.as_dict()
+        lines = ["Finished in {:.2f}s, peak memory {:.1f} MB".format(data['seconds'], data['peak_rss_megabytes'])]
+        for name, entry in sorted(data['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("  {:<10} {:8.2f}s {:6d} calls".format(name, entry['seconds'], entry['calls']))
+        if data['counters']:
+            lines.append("  " + ", ".join("{} {}".format(name, value) for name, value in sorted(data['counters'].items())))
+        return "\n".join(lines)
+
+
+# The metrics stage() and count() add to; collect() puts another one on top
+active = [Metrics()]
+
+
+def current():
+    return active[-1]
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current().add_time(name, time.perf_counter() - started)
+
+
+def count(name, amount=1):
+    current().count(name, amount)
+
+
+@contextmanager
+def collect():
+    # Metrics of one task of a worker process, to be returned with its result and merged by the parent
+    metrics = Metrics()
+    active.append(metrics)
+    try:
+        yield metrics
+    finally:
+        active.remove(metrics)
+
+
+def merge(data):
+    current().merge(data)
+
+
+@contextmanager
+def profiled(profiler=None, output=None):
+    if profiler is None:
+        yield
+        return
+    if profiler == 'pyinstrument':
+        if pyinstrument is None:
+            raise ImportError("pyinstrument is required for --profile pyinstrument")
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            if output:
+                with open(output, 'w') as f:
+                    f.write(profile.output_html())
+            else:
+                print(profile.output_text())
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if output:
+                profile.dump_stats(output)
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics', help="write stage timings, counters and peak memory to this JSON file")
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], help="profile the whole run")
+    parser.add_argument('--profile-output', help="save the profile (.prof for cprofile, .html for pyinstrument)")
+
+
+def write_metrics(path, script, metrics=None):
+    data = dict((metrics or current()).as_dict(), script=script)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+@contextmanager
+def instrumented(args, script):
+    # Wraps the work of a script's __main__ block; reports once it completed
+    with profiled(args.profile, args.profile_output):
+        yield current()
+    if args.metrics:
+        write_metrics(args.metrics, script)
+    print(current().summary())
@@ -0,0 +1,174 @@
+import json
+import bisect
+import argparse
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from log_catalog import default_catalog_path, open_catalog, update_catalog, iter_logs
+from log_reader import iter_log
+from log_names import parse_timestamp
+from async_io import bounded_map, add_arguments as add_io_arguments
+from gpt_archive import default_archive_path, open_archive, update_archive, load_responses
+
+# Puts the full log of every room session next to the GPT responses of the
+# same session and writes one JSON line per session. Both sides are matched
+# by spec and by the room start estimated from their file names, which are
+# written minutes apart: GPT responses at 2, 5 and 8 minutes, log 4 and log 5
+# at 10 and 11 minutes.
+
+# Minutes after the room start at which the log a full log was taken from is written
+full_log_minutes = {4: 10, 5: 11}
+default_tolerance = timedelta(minutes=3)
+
+response_fields = [
+    ('arguments_mentioned', 'arguments_mentioned_for_log_{}'),
+    ('arguments_not_mentioned', 'arguments_not_mentioned_for_log_{}'),
+    ('selected_argument', 'selected_missing_argument_for_log_{}'),
+]
+
+
+def split_arguments(value):
+    if value is None or value.strip() == 'None':
+        return []
+    return [argument.strip() for argument in value.split(',') if argument.strip()]
+
+
+def gpt_session_index(archive):
+    # spec -> (sorted estimated starts, session_start of each) for bisect lookups
+    index = {}
+    for row in archive.execute("SELECT DISTINCT spec, session_start FROM gpt_responses ORDER BY spec, session_start"):
+        starts, sessions = index.setdefault(row['spec'], ([], []))
+        starts.append(parse_timestamp(row['session_start']))
+        sessions.append(row['session_start'])
+    return index
+
+
+def match_session(index, spec, start, tolerance):
+    # The GPT session of spec whose start is nearest to start, if within tolerance
+    if spec not in index:
+        return None
+    starts, sessions = index[spec]
+    position = bisect.bisect_left(starts, start)
+    best = None
+    for candidate in (position - 1, position):
+        if 0 <= candidate < len(starts) and abs(starts[candidate] - start) <= tolerance:
+            if best is None or abs(starts[candidate] - start) < abs(starts[best] - start):
+                best = candidate
+    return sessions[best] if best is not None else None
+
+
+def gpt_record(archive, spec, session_start):
+    rows = archive.execute(
+        "SELECT * FROM gpt_responses WHERE spec = ? AND session_start = ? ORDER BY version, timestamp",
+        (spec, session_start)
+    ).fetchall()
+    # Each version repeats the responses of the earlier ones, so later files win
+    responses = {}
+    for row in rows:
+        responses.update(load_responses(row) or {})
+    versions = {}
+    for version in sorted(set(row['version'] for row in rows)):
+        record = {}
+        for name, key in response_fields:
+            value = responses.get(key.format(version))
+            record[name] = value if name == 'selected_argument' else split_arguments(value)
+        versions['v{}'.format(version)] = record
+    return {
+        'session_start': session_start,
+        'files': [row['path'] for row in rows],
+        'versions': versions,
+    }
+
+
+def compact_comments(path):
+    # Comments and replies of a log as flat rows in log order
+    rows = []
+
+    def add(comment, parent_id):
+        rows.append({
+            'id': comment.get('id'),
+            'parent_id': parent_id,
+            'time': comment.get('time'),
+            'user': comment.get('userName'),
+            'bot': bool(comment.get('bot')),
+            'content': comment.get('content'),
+        })
+        for reply in comment.get('replies') or []:
+            add(reply, comment.get('id'))
+
+    with open(path, 'r') as file:
+        for key, value in iter_log(file, ('comments',)):
+            if key == 'comments':
+                add(value, None)
+    return rows
+
+
+def join_sessions(catalog, archive, full_log_directories, tolerance=default_tolerance, jobs=1, io_concurrency=0):
+    index = gpt_session_index(archive)
+    records = []
+    matched = set()
+    for log in iter_logs(catalog, full_log_directories, kinds=('full',), recursive=True):
+        start = parse_timestamp(log['timestamp']) - timedelta(minutes=full_log_minutes.get(log['version'], 10))
+        session_start = match_session(index, log['spec'], start, tolerance)
+        records.append({
+            'spec': log['spec'],
+            'room_id': log['room_id'],
+            'start_time': log['session_start'],
+            'bot_type': log['bot_type'],
+            'full_log': log['path'],
+            'log_digest': log['comments_digest'],
+            'num_users': log['num_users'],
+            'num_users_speak': log['num_users_speak'],
+            'num_comments': log['num_comments'],
+            'gpt': gpt_record(archive, log['spec'], session_start) if session_start else None,
+        })
+        if session_start:
+            matched.add((log['spec'], session_start))
+
+    paths = [record['full_log'] for record in records]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            comments = list(executor.map(compact_comments, paths, chunksize=max(1, len(paths) // (jobs * 4))))
+    else:
+        comments = bounded_map(compact_comments, paths, io_concurrency)
+    for record, rows in zip(records, comments):
+        record['comments'] = rows
+
+    unmatched = [(spec, session_start) for spec, (_, sessions) in sorted(index.items())
+                 for session_start in sessions if (spec, session_start) not in matched]
+    return records, unmatched
+
+
+def write_sessions(records, output_jsonl):
+    with open(output_jsonl, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def read_sessions(output_jsonl):
+    with open(output_jsonl, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join full chat logs with the GPT responses of the same session.")
+    parser.add_argument('--full-logs', nargs='+', default=['/srv/chat-room/chat-room.git/full_logs/'])
+    parser.add_argument('--gpt-responses', nargs='+', default=['/srv/chat-room/server/private/gptResponses'])
+    parser.add_argument('--output', default='/srv/chat-room/chat-room.git/sessions.jsonl')
+    parser.add_argument('--tolerance', type=int, default=3, help="minutes the estimated room starts may differ")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes for reading logs")
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    update_catalog(catalog, args.full_logs, args.jobs, args.io_concurrency)
+    archive = open_archive(default_archive_path)
+    update_archive(archive, args.gpt_responses)
+
+    records, unmatched = join_sessions(catalog, archive, args.full_logs, timedelta(minutes=args.tolerance), args.jobs,
+                                       args.io_concurrency)
+    write_sessions(records, args.output)
+    print("Wrote {} sessions ({} with GPT responses) to {}".format(
+        len(records), sum(1 for record in records if record['gpt']), args.output))
+    for spec, session_start in unmatched:
+        print("GPT responses without a full log: {} {}".format(spec, session_start))
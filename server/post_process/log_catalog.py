@@ -0,0 +1,364 @@
+import os
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from log_reader import CommentsDigest
+from log_mmap import new_offsets, iter_indexed, iter_file
+from log_names import parse_log_filename
+from instrumentation import stage, count
+from async_io import bounded_map
+
+# Persistent index of every chat log seen by the post_process scripts.
+# One scan records room, version, timestamp, size and mtime of each log together
+# with its user/comment counts; later scans only re-read new or changed files.
+
+default_catalog_path = '/srv/chat-room/chat-room.git/log_catalog.sqlite'
+
+# Bump when the schema below changes
+catalog_version = 7
+
+schema = """
+CREATE TABLE IF NOT EXISTS logs (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    room_id INTEGER,
+    timestamp TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    device INTEGER,
+    inode INTEGER,
+    session_start TEXT,
+    bot_type TEXT,
+    num_users INTEGER,
+    num_comments INTEGER,
+    num_users_speak INTEGER,
+    comments_digest TEXT
+);
+CREATE TABLE IF NOT EXISTS log_users (
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT,
+    prolific_pid TEXT,
+    num_comments INTEGER NOT NULL,
+    PRIMARY KEY (path, position)
+);
+CREATE TABLE IF NOT EXISTS log_comments (
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    comment_id INTEGER,
+    time TEXT,
+    hash TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    PRIMARY KEY (path, position)
+);
+CREATE TABLE IF NOT EXISTS log_offsets (
+    path TEXT PRIMARY KEY,
+    offsets TEXT NOT NULL
+);
+-- Sessions whose logs were added, changed or removed, for indexes built on the
+-- catalog (participant_index) to refresh; they clear it once they caught up
+CREATE TABLE IF NOT EXISTS log_changes (
+    spec TEXT NOT NULL,
+    session_start TEXT NOT NULL,
+    PRIMARY KEY (spec, session_start)
+);
+CREATE TRIGGER IF NOT EXISTS logs_inserted AFTER INSERT ON logs WHEN new.session_start IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO log_changes VALUES (new.spec, new.session_start);
+END;
+CREATE TRIGGER IF NOT EXISTS logs_updated AFTER UPDATE ON logs BEGIN
+    INSERT OR IGNORE INTO log_changes SELECT old.spec, old.session_start WHERE old.session_start IS NOT NULL;
+    INSERT OR IGNORE INTO log_changes SELECT new.spec, new.session_start WHERE new.session_start IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS logs_deleted AFTER DELETE ON logs WHEN old.session_start IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO log_changes VALUES (old.spec, old.session_start);
+END;
+CREATE INDEX IF NOT EXISTS logs_directory ON logs (directory);
+CREATE INDEX IF NOT EXISTS logs_room_version ON logs (room_id, version);
+CREATE INDEX IF NOT EXISTS logs_session ON logs (spec, session_start);
+CREATE INDEX IF NOT EXISTS log_users_pid ON log_users (prolific_pid);
+"""
+
+
+def catalog_directory(directory):
+    # Directories and paths are stored absolute, so a relative argument finds the same rows
+    return os.path.abspath(directory)
+
+
+def subdirectory_condition(column, directory):
+    # SQL condition (and its parameters) for a directory column naming a subdirectory of
+    # directory; compared by prefix, as LIKE ignores case and takes '_' for any character
+    prefix = directory + os.sep
+    return "substr({}, 1, ?) = ?".format(column), [len(prefix), prefix]
+
+
+def open_catalog(catalog_path=default_catalog_path):
+    conn = sqlite3.connect(catalog_path)
+    conn.row_factory = sqlite3.Row
+    # The catalog is a cache of the log files, so an outdated layout is simply rebuilt,
+    # together with the participant index kept next to it
+    if conn.execute("PRAGMA user_version").fetchone()[0] != catalog_version:
+        conn.executescript("DROP TABLE IF EXISTS logs; DROP TABLE IF EXISTS log_users; DROP TABLE IF EXISTS log_comments; "
+                           "DROP TABLE IF EXISTS log_offsets; DROP TABLE IF EXISTS log_changes; "
+                           "DROP TABLE IF EXISTS participant_sessions; DROP TABLE IF EXISTS participant_index_state;")
+        conn.execute("PRAGMA user_version = {}".format(catalog_version))
+    conn.executescript(schema)
+    return conn
+
+
+def extract_log_metadata(file_path, content=None):
+    # content: the bytes of the file, if they were read already
+    fields = {}
+    users = []
+    comments_per_name = {}
+    digest = CommentsDigest()
+
+    # Users and comments are decoded one at a time and only their names kept; the
+    # byte range of each is recorded, so later passes can decode single items
+    if content is None:
+        offsets = new_offsets(os.path.getsize(file_path))
+        values = iter_file(file_path, offsets)
+    else:
+        offsets = new_offsets(len(content))
+        values = iter_indexed(content, offsets)
+    for key, value in values:
+        if key == "users":
+            users.append(value)
+        elif key == "comments":
+            comments_per_name[value.get("userName")] = comments_per_name.get(value.get("userName"), 0) + 1
+            digest.update(value)
+        else:
+            fields[key] = value
+
+    user_rows = []
+    for user in users:
+        user_rows.append((user.get("name"), user.get("prolificPid"), comments_per_name.get(user.get("name"), 0)))
+
+    # A participant speaks if any top-level comment carries their name
+    name_to_pid = {user.get("name"): user.get("prolificPid") for user in users}
+    speaking_pids = set(pid for name, pid in name_to_pid.items() if comments_per_name.get(name))
+
+    return {
+        'session_start': fields.get("startTime"),
+        'bot_type': fields.get("botType"),
+        'num_users': len(name_to_pid),
+        'num_comments': digest.count,
+        'num_users_speak': len(speaking_pids),
+        'comments_digest': digest.hexdigest(),
+        'users': user_rows,
+        'comments': digest.comments,
+        'offsets': offsets,
+    }
+
+
+def read_log_metadata(file_path, content=None):
+    try:
+        return extract_log_metadata(file_path, content)
+    except ValueError:
+        # Keep unreadable logs in the catalog so they are not re-parsed on every run
+        return {}
+
+
+def prefetch_log_metadata(file_path):
+    # Reads the file with one call, which releases the GIL while it waits on the disk
+    # (page faults on a memory map would hold it); used by the --io-concurrency threads
+    with open(file_path, 'rb') as f:
+        return read_log_metadata(file_path, f.read())
+
+
+def scan_directory(directory, suffix='log.json', io_concurrency=0):
+    # Yields (path, directory, filename, stat) for every log file (or other file ending in suffix) below
+    # directory; with io_concurrency, the files of a directory are stat-ed concurrently
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError:
+            continue
+        files = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.endswith(suffix):
+                files.append(entry)
+        for entry, stat in zip(files, bounded_map(os.DirEntry.stat, files, io_concurrency)):
+            yield entry.path, current, entry.name, stat
+
+
+def delete_log(conn, path):
+    conn.execute("DELETE FROM log_users WHERE path = ?", (path,))
+    conn.execute("DELETE FROM log_comments WHERE path = ?", (path,))
+    conn.execute("DELETE FROM log_offsets WHERE path = ?", (path,))
+    conn.execute("DELETE FROM logs WHERE path = ?", (path,))
+
+
+def store_log(conn, path, directory, filename, name_info, stat, metadata):
+    delete_log(conn, path)
+    conn.execute(
+        "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (path, directory, filename, name_info.spec, name_info.room_id, name_info.timestamp,
+         name_info.version, name_info.kind, stat.st_size, stat.st_mtime, stat.st_dev, stat.st_ino,
+         metadata.get('session_start'), metadata.get('bot_type'), metadata.get('num_users'),
+         metadata.get('num_comments'), metadata.get('num_users_speak'), metadata.get('comments_digest'))
+    )
+    conn.executemany(
+        "INSERT INTO log_users VALUES (?, ?, ?, ?, ?)",
+        [(path, position, name, pid, count) for position, (name, pid, count) in enumerate(metadata.get('users', []))]
+    )
+    conn.executemany(
+        "INSERT INTO log_comments VALUES (?, ?, ?, ?, ?, ?)",
+        [(path, position, comment_id, time, value, messages)
+         for position, (comment_id, time, value, messages) in enumerate(metadata.get('comments', []))]
+    )
+    if metadata.get('offsets'):
+        conn.execute("INSERT INTO log_offsets VALUES (?, ?)",
+                     (path, json.dumps(metadata['offsets'], separators=(',', ':'))))
+
+
+def move_log(conn, old_path, path, directory, filename, name_info):
+    conn.execute(
+        "UPDATE logs SET path = ?, directory = ?, filename = ?, spec = ?, room_id = ?, timestamp = ?, "
+        "version = ?, kind = ? WHERE path = ?",
+        (path, directory, filename, name_info.spec, name_info.room_id, name_info.timestamp,
+         name_info.version, name_info.kind, old_path)
+    )
+    conn.execute("UPDATE log_users SET path = ? WHERE path = ?", (path, old_path))
+    conn.execute("UPDATE log_comments SET path = ? WHERE path = ?", (path, old_path))
+    conn.execute("UPDATE log_offsets SET path = ? WHERE path = ?", (path, old_path))
+
+
+def read_all_metadata(paths, jobs=1, io_concurrency=0):
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(read_log_metadata, paths, chunksize=max(1, len(paths) // (jobs * 4))))
+    if io_concurrency > 1:
+        return bounded_map(prefetch_log_metadata, paths, io_concurrency)
+    return [read_log_metadata(path) for path in paths]
+
+
+def update_catalog(conn, directories, jobs=1, io_concurrency=0):
+    # io_concurrency overlaps the stat calls and reads of the files (see async_io); it
+    # applies when jobs is 1, as worker processes already read in parallel
+    summary = {'added': 0, 'updated': 0, 'renamed': 0, 'removed': 0, 'unchanged': 0}
+    to_read = []
+
+    with stage('scan'):
+        for directory in directories:
+            directory = catalog_directory(directory)
+            known = {}
+            below, below_params = subdirectory_condition('directory', directory)
+            for row in conn.execute(
+                    "SELECT path, size, mtime, device, inode, spec, timestamp FROM logs "
+                    "WHERE directory = ? OR " + below, [directory] + below_params):
+                known[row['path']] = row
+
+            new_files = []
+            for path, parent, filename, stat in scan_directory(directory, io_concurrency=io_concurrency):
+                name_info = parse_log_filename(filename)
+                if name_info is None:
+                    continue
+                previous = known.pop(path, None)
+                if previous is None:
+                    new_files.append((path, parent, filename, name_info, stat))
+                elif (previous['size'], previous['mtime'], previous['inode']) == (stat.st_size, stat.st_mtime, stat.st_ino):
+                    summary['unchanged'] += 1
+                else:
+                    to_read.append((path, parent, filename, name_info, stat))
+                    summary['updated'] += 1
+
+            # os.rename keeps the inode, size and mtime, so a vanished entry with the same
+            # stat is the same file under its new name (rename_log, correct_log_5) and needs
+            # no re-read. The renames keep spec and time in the name; requiring them as well
+            # guards against file systems without stable inode numbers
+            vanished = {}
+            for path, row in known.items():
+                vanished[(row['device'], row['inode'], row['size'], row['mtime'], row['spec'], row['timestamp'])] = path
+            for path, parent, filename, name_info, stat in new_files:
+                old_path = vanished.pop((stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+                                         name_info.spec, name_info.timestamp), None)
+                if old_path is not None:
+                    del known[old_path]
+                    move_log(conn, old_path, path, parent, filename, name_info)
+                    summary['renamed'] += 1
+                else:
+                    to_read.append((path, parent, filename, name_info, stat))
+                    summary['added'] += 1
+
+            # Files that disappeared since the last scan
+            for path in known:
+                delete_log(conn, path)
+                summary['removed'] += 1
+
+    # Parsing is the expensive part and may run in worker processes; rows are stored in scan order
+    with stage('parse'):
+        metadata = read_all_metadata([entry[0] for entry in to_read], jobs, io_concurrency)
+    count('files_parsed', len(to_read))
+    count('bytes_parsed', sum(entry[4].st_size for entry in to_read))
+    count('comments_parsed', sum(log_metadata.get('num_comments') or 0 for log_metadata in metadata))
+
+    with stage('store'):
+        for (path, parent, filename, name_info, stat), log_metadata in zip(to_read, metadata):
+            store_log(conn, path, parent, filename, name_info, stat, log_metadata)
+        conn.commit()
+
+    for key, value in summary.items():
+        count('logs_' + key, value)
+    return summary
+
+
+def directory_filter(directories, recursive=False):
+    # SQL condition restricting logs.directory to the given directories
+    clauses = []
+    params = []
+    for directory in directories:
+        directory = catalog_directory(directory)
+        clauses.append("logs.directory = ?")
+        params.append(directory)
+        if recursive:
+            below, below_params = subdirectory_condition('logs.directory', directory)
+            clauses.append(below)
+            params.extend(below_params)
+    return '(' + ' OR '.join(clauses) + ')', params
+
+
+def iter_logs(conn, directories, versions=None, kinds=('log',), recursive=False):
+    where, params = directory_filter(directories, recursive)
+    query = "SELECT * FROM logs WHERE " + where
+    query += " AND kind IN ({})".format(', '.join('?' * len(kinds)))
+    params.extend(kinds)
+    if versions is not None:
+        query += " AND version IN ({})".format(', '.join('?' * len(versions)))
+        params.extend(versions)
+    query += " ORDER BY directory, filename"
+    return conn.execute(query, params)
+
+
+def log_comment_hashes(conn, paths):
+    # {path: [(comment_id, hash, message hashes), ...]} in log order, read from the catalog only
+    hashes = {path: [] for path in paths}
+    paths = list(paths)
+    for start in range(0, len(paths), 500):
+        batch = paths[start:start + 500]
+        for row in conn.execute(
+                "SELECT path, comment_id, hash, messages FROM log_comments WHERE path IN ({}) ORDER BY path, position".format(
+                    ', '.join('?' * len(batch))), batch):
+            hashes[row['path']].append((row['comment_id'], row['hash'], row['messages'].split()))
+    return hashes
+
+
+def log_offsets(conn, path):
+    # Byte ranges of the fields, users and comments of a log (see log_mmap), if it could be read
+    row = conn.execute("SELECT offsets FROM log_offsets WHERE path = ?", (path,)).fetchone()
+    return json.loads(row['offsets']) if row else None
+
+
+if __name__ == "__main__":
+    import sys
+
+    catalog = open_catalog(default_catalog_path)
+    for directory in sys.argv[1:]:
+        print("{}: {}".format(directory, update_catalog(catalog, [directory])))
@@ -0,0 +1,136 @@
+import json
+import argparse
+from log_catalog import default_catalog_path, open_catalog, update_catalog, directory_filter, log_comment_hashes
+from log_reader import comment_hash
+from log_mmap import open_mapped
+
+# Content-hash based comparison of log versions. The catalog keeps one hash per
+# comment (id, time, userName, content, replies) and one per message of its
+# thread, so logs can be compared, and duplicate or truncated copies found,
+# without loading the log files again. A comment is held by a log that has the
+# comment with all of its replies, and possibly more.
+
+
+def comment_key(comment_id, value):
+    return comment_id if comment_id is not None else value
+
+def key_of(comment):
+    return comment_key(comment.get('id'), comment_hash(comment) if comment.get('id') is None else None)
+
+def added_comments(base, other):
+    # Ids of comments that other has and base lacks, or holds without some of their
+    # replies or in a different form; both arguments are [(comment_id, hash, message
+    # hashes)] lists as stored in the catalog
+    base_comments = dict((comment_key(comment_id, value), (value, messages)) for comment_id, value, messages in base)
+    added = set()
+    for comment_id, value, messages in other:
+        key = comment_key(comment_id, value)
+        base_value, base_messages = base_comments.get(key, (None, ()))
+        if base_value != value and not set(messages).issubset(base_messages):
+            added.add(key)
+    return added
+
+def contains(base, other):
+    return not added_comments(base, other)
+
+def merge_comment(kept, other):
+    if comment_hash(kept) == comment_hash(other):
+        return kept
+    # Same comment seen in two versions of the log; keep kept's fields and every reply once
+    replies = {}
+    for reply in (kept.get('replies') or []) + (other.get('replies') or []):
+        key = key_of(reply)
+        replies[key] = merge_comment(replies[key], reply) if key in replies else reply
+    merged = dict(kept)
+    if replies:
+        merged['replies'] = sorted(replies.values(), key=lambda reply: reply.get('time') or '')
+    return merged
+
+def union_logs(logs):
+    # Logs are ordered by preference; the first one supplies the metadata
+    union = dict(logs[0])
+    users = {}
+    comments = {}
+    for log in logs:
+        for user in log.get('users') or []:
+            users.setdefault((user.get('name'), user.get('prolificPid')), user)
+        for comment in log.get('comments') or []:
+            key = key_of(comment)
+            comments[key] = merge_comment(comments[key], comment) if key in comments else comment
+    union['users'] = list(users.values())
+    # Stable sort, so comments sharing a timestamp keep their logged order
+    union['comments'] = sorted(comments.values(), key=lambda comment: comment.get('time') or '')
+    return union
+
+def load_log(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def reconstruct_union(paths, hashes, offsets=None):
+    # Union of several logs of one room session. The log with the most comments is
+    # the base; another log is only read if the catalog shows it adds comments, and
+    # only those comments (found by their position in the catalog) are decoded.
+    # offsets maps paths to their byte ranges from the catalog, if known
+    paths = sorted(paths, key=lambda path: -len(hashes[path]))
+    base_path = paths[0]
+    logs = [load_log(base_path)]
+    for path in paths[1:]:
+        extra = added_comments(hashes[base_path], hashes[path])
+        if not extra:
+            continue
+        positions = [position for position, (comment_id, value, _) in enumerate(hashes[path])
+                     if comment_key(comment_id, value) in extra]
+        with open_mapped(path, (offsets or {}).get(path)) as log:
+            logs.append({'users': list(log.users()), 'comments': list(log.comments(positions))})
+    return union_logs(logs)
+
+def find_duplicate_logs(conn, directories, recursive=True):
+    # Groups logs by room session and version across directories and classifies every
+    # copy against the most complete one: duplicate, truncated or diverged
+    where, params = directory_filter(directories, recursive)
+    rows = conn.execute(
+        "SELECT path, spec, session_start, version, comments_digest, num_comments FROM logs WHERE " + where +
+        " AND kind = 'log' AND session_start IS NOT NULL ORDER BY spec, session_start, version, path", params
+    ).fetchall()
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['spec'], row['session_start'], row['version']), []).append(row)
+
+    copies = [group for group in groups.values() if len(group) > 1]
+    hashes = log_comment_hashes(conn, [row['path'] for group in copies for row in group])
+
+    report = []
+    for group in copies:
+        base = max(group, key=lambda row: row['num_comments'] or 0)
+        for row in group:
+            if row is base:
+                continue
+            if row['comments_digest'] == base['comments_digest']:
+                status = 'duplicate'
+            elif contains(hashes[base['path']], hashes[row['path']]):
+                status = 'truncated'
+            else:
+                status = 'diverged'
+            report.append({
+                'spec': row['spec'],
+                'session_start': row['session_start'],
+                'version': row['version'],
+                'path': row['path'],
+                'reference': base['path'],
+                'status': status,
+            })
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find duplicate and truncated copies of chat logs.")
+    parser.add_argument('directories', nargs='+', help="chatlog directories to compare")
+    parser.add_argument('--output', default='/srv/chat-room/chat-room.git/duplicate_logs.json')
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    update_catalog(catalog, args.directories)
+    duplicates = find_duplicate_logs(catalog, args.directories)
+    with open(args.output, 'w') as f:
+        json.dump(duplicates, f, indent=2)
+    print("Found {} duplicate or truncated logs".format(len(duplicates)))
@@ -0,0 +1,205 @@
+import re
+import json
+import mmap
+import argparse
+
+# Memory-mapped access to single chat logs through an index of byte ranges:
+# one per top-level field and one per item of the "users" and "comments"
+# arrays. The ranges are found in one pass when a log is first read (the
+# catalog and log packs keep them), after which any single field, user or
+# comment is decoded straight from its bytes. A pass over the users of a log
+# then never touches its comments, and a merge decodes only the comments it
+# takes from a log.
+
+whitespace = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+indexed_arrays = ('users', 'comments')
+
+
+class ByteOffsets(object):
+    # Byte offsets in the UTF-8 encoding of text, for character offsets asked in increasing order
+    def __init__(self, text, size):
+        self.text = text
+        self.ascii = len(text) == size
+        self.char = 0
+        self.byte = 0
+
+    def __call__(self, char):
+        if self.ascii:
+            return char
+        self.byte += len(self.text[self.char:char].encode('utf-8'))
+        self.char = char
+        return self.byte
+
+
+def new_offsets(size):
+    # {'size': n, 'fields': {key: [start, end]}, 'users': [[start, end], ...], 'comments': [...]}
+    offsets = {'size': size, 'fields': {}}
+    for key in indexed_arrays:
+        offsets[key] = []
+    return offsets
+
+
+def iter_indexed(buffer, offsets):
+    # Like log_reader.iter_log over a whole log in memory; the byte range of every
+    # value yielded is recorded in offsets (see new_offsets) on the way
+    text = buffer[:].decode('utf-8')
+    byte_offset = ByteOffsets(text, len(buffer))
+
+    def peek(pos):
+        pos = whitespace.match(text, pos).end()
+        if pos == len(text):
+            raise ValueError("Unexpected end of log file")
+        return pos, text[pos]
+
+    def expect(pos, char):
+        pos, found = peek(pos)
+        if found != char:
+            raise ValueError("Expected {!r} at offset {} of log file".format(char, byte_offset(pos)))
+        return pos + 1
+
+    def decode(pos):
+        pos, _ = peek(pos)
+        value, end = decoder.raw_decode(text, pos)
+        return value, [byte_offset(pos), byte_offset(end)], end
+
+    pos = expect(0, '{')
+    if peek(pos)[1] == '}':
+        return
+    while True:
+        key, _, pos = decode(pos)
+        pos = expect(pos, ':')
+        pos, char = peek(pos)
+        if key in indexed_arrays and char == '[':
+            start = byte_offset(pos)
+            pos, char = peek(pos + 1)
+            while char != ']':
+                value, span, pos = decode(pos)
+                offsets[key].append(span)
+                yield key, value
+                pos, char = peek(pos)
+                if char != ']':
+                    pos = expect(pos, ',')
+            pos += 1
+            offsets['fields'][key] = [start, byte_offset(pos)]
+        else:
+            value, span, pos = decode(pos)
+            offsets['fields'][key] = span
+            yield key, value
+        pos, char = peek(pos)
+        if char == '}':
+            return
+        pos = expect(pos, ',')
+
+
+def scan_offsets(buffer):
+    offsets = new_offsets(len(buffer))
+    for _ in iter_indexed(buffer, offsets):
+        pass
+    return offsets
+
+
+class MappedLog(object):
+    # A log held in a buffer: a memory map of the file, or the bytes of a packed log
+    def __init__(self, buffer, offsets=None, mapping=None):
+        self.buffer = buffer
+        self.mapping = mapping
+        # Ranges recorded for a file of another size belong to an older version of it
+        if offsets is None or offsets.get('size') != len(buffer):
+            offsets = scan_offsets(buffer)
+        self.offsets = offsets
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def raw(self, span):
+        start, end = span
+        return self.buffer[start:end]
+
+    def decode(self, span):
+        return decoder.decode(self.raw(span).decode('utf-8'))
+
+    def keys(self):
+        return list(self.offsets['fields'])
+
+    def field(self, key, default=None):
+        span = self.offsets['fields'].get(key)
+        return self.decode(span) if span is not None else default
+
+    def fields(self):
+        # The top-level fields other than the indexed arrays, in file order
+        return dict((key, self.decode(span)) for key, span in self.offsets['fields'].items()
+                    if key not in indexed_arrays)
+
+    def count(self, key):
+        return len(self.offsets[key])
+
+    def items(self, key, positions=None):
+        spans = self.offsets[key]
+        if positions is None:
+            positions = range(len(spans))
+        for position in positions:
+            yield self.decode(spans[position])
+
+    def users(self):
+        return self.items('users')
+
+    def comments(self, positions=None):
+        return self.items('comments', positions)
+
+
+def map_file(path):
+    # Raises ValueError for an empty file, like any other unreadable log
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_mapped(path, offsets=None):
+    mapping = map_file(path)
+    try:
+        return MappedLog(mapping, offsets, mapping)
+    except ValueError:
+        mapping.close()
+        raise
+
+
+def iter_file(path, offsets):
+    # iter_indexed over a log file, for readers that need every value anyway
+    mapping = map_file(path)
+    try:
+        for key, value in iter_indexed(mapping, offsets):
+            yield key, value
+    finally:
+        mapping.close()
+
+
+def open_packed(pack, name):
+    # A log stored in a log_pack.LogPack, with the ranges recorded when it was packed
+    return MappedLog(pack.read(name), pack.members[name].get('offsets'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the byte ranges of the fields, users and comments of a log.")
+    parser.add_argument('log', help="log file, or the name of a log in --pack")
+    parser.add_argument('--pack', help="read the log from this log pack")
+    args = parser.parse_args()
+
+    if args.pack:
+        from log_pack import LogPack
+        log = open_packed(LogPack(args.pack), args.log)
+    else:
+        log = open_mapped(args.log)
+    with log:
+        for key, (start, end) in log.offsets['fields'].items():
+            print("{}\t{}\t{}".format(key, start, end))
+        for key in indexed_arrays:
+            print("{}: {} items".format(key, log.count(key)))
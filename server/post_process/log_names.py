@@ -0,0 +1,66 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+from collections import namedtuple
+
+# The file names the post_process scripts read, parsed in one place:
+#
+#   <spec>_<D.MM.YYYY-HH:mm>_<version>.log.json      Logs.writeLog             kind 'raw'
+#   <spec>_<D.MM.YYYY-HH.mm>_<version>_log.json      rename_log, correct_log_5 kind 'log'
+#   <spec>_<D.MM.YYYY-HH.mm>_<version>_full_log.json merge_log                 kind 'full'
+#   <spec>.json_<D.MM.YYYY-HH:mm>_v<version>.json    saveGPTResponses in gpt.ts kind 'gpt'
+#   <spec>_<D.MM.YYYY-HH.mm>_full.json               select_gptresponse (v3)   kind 'gpt'
+#
+# Scans see the same names again and again (every catalog update lists whole
+# directories), so results are memoized.
+
+log_name_pattern = re.compile(
+    r'^(?P<spec>.+?)_(?P<date>\d{1,2})\.(?P<month>\d{2})\.(?P<year>\d{4})-(?P<hour>\d{2})[.:](?P<minute>\d{2})'
+    r'_(?P<version>\d+)(?P<suffix>\.log|_log|_full_log)\.json$'
+)
+response_name_pattern = re.compile(
+    r'^(?P<spec>.+?)(?:\.json)?_(?P<date>\d{1,2})\.(?P<month>\d{2})\.(?P<year>\d{4})-(?P<hour>\d{2})[.:](?P<minute>\d{2})'
+    r'_(?P<version>v\d+|full)\.json$'
+)
+room_id_pattern = re.compile(r'_(\d+)$')
+
+log_kinds = {'.log': 'raw', '_log': 'log', '_full_log': 'full'}
+
+# timestamp is the text of time as str(datetime) gives it, as stored in the catalogs and CSV outputs
+LogName = namedtuple('LogName', ['spec', 'room_id', 'timestamp', 'time', 'version', 'kind'])
+
+cache_size = 1 << 16
+
+
+def name_record(match, version, kind):
+    spec = match.group('spec')
+    room_match = room_id_pattern.search(spec)
+    try:
+        time = datetime(int(match.group('year')), int(match.group('month')), int(match.group('date')),
+                        int(match.group('hour')), int(match.group('minute')))
+    except ValueError:
+        return None
+    return LogName(spec, int(room_match.group(1)) if room_match else None, str(time), time, version, kind)
+
+
+@lru_cache(maxsize=cache_size)
+def parse_log_filename(filename):
+    match = log_name_pattern.match(filename)
+    if not match:
+        return None
+    return name_record(match, int(match.group('version')), log_kinds[match.group('suffix')])
+
+
+@lru_cache(maxsize=cache_size)
+def parse_response_filename(filename):
+    match = response_name_pattern.match(filename)
+    if not match:
+        return None
+    version = match.group('version')
+    return name_record(match, 3 if version == 'full' else int(version[1:]), 'gpt')
+
+
+@lru_cache(maxsize=cache_size)
+def parse_timestamp(timestamp):
+    # A timestamp column of the catalogs ('%Y-%m-%d %H:%M:%S') as a datetime
+    return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') if timestamp else None
@@ -0,0 +1,279 @@
+import os
+import gzip
+import json
+import zlib
+import struct
+import hashlib
+import argparse
+from log_names import parse_log_filename
+from log_mmap import scan_offsets
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Packs a chatlog directory into one append-only file. Logs of the same room
+# and day, whose versions overlap heavily, are compressed together into one
+# frame; a footer index maps every file to its frame so each log can still be
+# read on its own. Appending writes new frames and a new footer after the old
+# ones, so an interrupted append leaves the previous contents readable. The
+# index also keeps the byte ranges of the users and comments of every log, so
+# log_mmap.open_packed can decode single items of a packed log.
+#
+#   frame | frame | ... | index | trailer
+#   trailer = magic, index offset, index length
+
+magic = b'CRLPACK1'
+trailer_format = '<8sQQ'
+trailer_size = struct.calcsize(trailer_format)
+# Largest amount of log data compressed into one frame
+frame_limit = 4 * 1024 * 1024
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd frames")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def frame_key(name):
+    # Logs of one room and day share a frame; other files are packed by name
+    name_info = parse_log_filename(os.path.basename(name))
+    if name_info is None:
+        return (os.path.dirname(name), name, '')
+    return (os.path.dirname(name), name_info.spec, name_info.timestamp[:10])
+
+
+def log_offsets(name, content):
+    # Byte ranges of the fields, users and comments of a packed log (see log_mmap)
+    if parse_log_filename(os.path.basename(name)) is None:
+        return None
+    try:
+        return scan_offsets(content)
+    except ValueError:
+        return None
+
+
+class LogPack(object):
+    def __init__(self, path):
+        self.path = path
+        self.frames = []
+        # name -> member entry; a name appended again points to its newest copy
+        self.members = {}
+        self.index_end = 0
+        if os.path.exists(path):
+            self.read_index()
+
+    def read_index(self):
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            # The last complete trailer; an interrupted append leaves garbage after it
+            while True:
+                end = self.find_trailer(f, end)
+                if end is None:
+                    raise ValueError("{} is not a log pack".format(self.path))
+                f.seek(end - trailer_size)
+                _, index_offset, index_length = struct.unpack(trailer_format, f.read(trailer_size))
+                if index_offset + index_length + trailer_size == end:
+                    f.seek(index_offset)
+                    try:
+                        index = json.loads(gzip.decompress(f.read(index_length)))
+                        break
+                    except (OSError, EOFError, ValueError, zlib.error):
+                        pass
+                end -= 1
+        self.frames = index['frames']
+        self.members = dict((member['name'], member) for member in index['members'])
+        self.index_end = end
+
+    def find_trailer(self, f, end):
+        # End offset of the last trailer ending at or before end
+        position = end
+        while position >= trailer_size:
+            start = max(0, position - 65536)
+            f.seek(start)
+            block = f.read(position - start)
+            found = block.rfind(magic)
+            while found != -1:
+                if start + found + trailer_size <= end:
+                    return start + found + trailer_size
+                found = block.rfind(magic, 0, found)
+            if start == 0:
+                return None
+            position = start + len(magic) - 1
+        return None
+
+    def names(self):
+        return sorted(self.members)
+
+    def read(self, name):
+        member = self.members[name]
+        frame = self.frames[member['frame']]
+        with open(self.path, 'rb') as f:
+            f.seek(frame['offset'])
+            data = decompress(f.read(frame['length']), frame['codec'])
+        return data[member['start']:member['start'] + member['size']]
+
+    def iter_members(self, names=None):
+        # Yields (name, bytes); every frame is decompressed once
+        wanted = self.names() if names is None else sorted(names)
+        by_frame = {}
+        for name in wanted:
+            by_frame.setdefault(self.members[name]['frame'], []).append(name)
+        with open(self.path, 'rb') as f:
+            for frame_number in sorted(by_frame):
+                frame = self.frames[frame_number]
+                f.seek(frame['offset'])
+                data = decompress(f.read(frame['length']), frame['codec'])
+                for name in by_frame[frame_number]:
+                    member = self.members[name]
+                    yield name, data[member['start']:member['start'] + member['size']]
+
+    def append(self, files, codec=None):
+        # files: [(name, path)]; files already packed with the same size and mtime are skipped
+        codec = codec or default_codec()
+        pending = []
+        for name, path in files:
+            stat = os.stat(path)
+            member = self.members.get(name)
+            if member and member['size'] == stat.st_size and member['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            pending.append((frame_key(name), name, path, stat))
+        if not pending:
+            return []
+        pending.sort()
+
+        groups = []
+        for key, name, path, stat in pending:
+            if not groups or groups[-1][0] != key or groups[-1][1] + stat.st_size > frame_limit:
+                groups.append([key, 0, []])
+            groups[-1][1] += stat.st_size
+            groups[-1][2].append((name, path, stat))
+
+        mode = 'r+b' if os.path.exists(self.path) else 'wb'
+        with open(self.path, mode) as f:
+            f.seek(self.index_end)
+            for _, _, members in groups:
+                data = bytearray()
+                frame_members = []
+                for name, path, stat in members:
+                    with open(path, 'rb') as source:
+                        content = source.read()
+                    frame_members.append({
+                        'name': name,
+                        'frame': len(self.frames),
+                        'start': len(data),
+                        'size': len(content),
+                        'mtime_ns': stat.st_mtime_ns,
+                        'mode': stat.st_mode & 0o777,
+                        'hash': hashlib.blake2b(content, digest_size=16).hexdigest(),
+                        'offsets': log_offsets(name, content),
+                    })
+                    data.extend(content)
+                compressed = compress(bytes(data), codec)
+                self.frames.append({'offset': f.tell(), 'length': len(compressed), 'codec': codec})
+                f.write(compressed)
+                for member in frame_members:
+                    self.members[member['name']] = member
+            self.write_index(f)
+        return [name for _, name, _, _ in pending]
+
+    def write_index(self, f):
+        index = gzip.compress(json.dumps({'frames': self.frames, 'members': list(self.members.values())}).encode('utf-8'),
+                              mtime=0)
+        index_offset = f.tell()
+        f.write(index)
+        f.write(struct.pack(trailer_format, magic, index_offset, len(index)))
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        self.index_end = f.tell()
+
+    def unpack(self, directory, names=None):
+        # Writes the files back with their contents, permissions and modification times
+        count = 0
+        for name, data in self.iter_members(names):
+            member = self.members[name]
+            if hashlib.blake2b(data, digest_size=16).hexdigest() != member['hash']:
+                raise ValueError("{} is corrupted in {}".format(name, self.path))
+            path = os.path.join(directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.chmod(path, member['mode'])
+            os.utime(path, ns=(member['mtime_ns'], member['mtime_ns']))
+            count += 1
+        return count
+
+
+def directory_files(directory):
+    # (name relative to directory, path) of every file below directory
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            files.append((os.path.relpath(path, directory), path))
+    return sorted(files)
+
+
+def pack_directory(directory, pack_path, remove=False, codec=None):
+    pack = LogPack(pack_path)
+    files = directory_files(directory)
+    added = pack.append(files, codec)
+    if remove:
+        # Only files whose packed copy matches them byte for byte are deleted
+        packed = dict(pack.iter_members([name for name, _ in files]))
+        for name, path in files:
+            with open(path, 'rb') as f:
+                if f.read() == packed[name]:
+                    os.remove(path)
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack chat log directories into compressed append-only files.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack_command = commands.add_parser('pack', help="add the files of a directory to a pack")
+    pack_command.add_argument('directory')
+    pack_command.add_argument('--output', help="pack file (default: <directory>.logpack)")
+    pack_command.add_argument('--remove', action='store_true', help="delete the files once they are packed")
+    pack_command.add_argument('--codec', choices=['zstd', 'gzip'], help="default: zstd if installed, else gzip")
+    unpack_command = commands.add_parser('unpack', help="write the files of a pack back to a directory")
+    unpack_command.add_argument('pack')
+    unpack_command.add_argument('directory')
+    unpack_command.add_argument('names', nargs='*', help="only these files")
+    list_command = commands.add_parser('list', help="list the files of a pack")
+    list_command.add_argument('pack')
+    cat_command = commands.add_parser('cat', help="print one file of a pack")
+    cat_command.add_argument('pack')
+    cat_command.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        pack_path = args.output or os.path.normpath(args.directory) + '.logpack'
+        added = pack_directory(args.directory, pack_path, args.remove, args.codec)
+        print("Packed {} files into {}".format(len(added), pack_path))
+    elif args.command == 'unpack':
+        count = LogPack(args.pack).unpack(args.directory, args.names or None)
+        print("Unpacked {} files into {}".format(count, args.directory))
+    elif args.command == 'list':
+        pack = LogPack(args.pack)
+        for name in pack.names():
+            print("{}\t{}".format(pack.members[name]['size'], name))
+    elif args.command == 'cat':
+        print(LogPack(args.pack).read(args.name).decode('utf-8'), end='')
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+# Pairs each log4 of a room with the log5 written shortly after it.
+# Both sides are sorted by timestamp once and matched with a two-pointer sweep,
+# so a room with many restarts pairs in linear time after sorting.
+
+default_min_delta = timedelta(minutes=1)
+default_max_delta = timedelta(minutes=2)
+
+
+def pair_logs(log4_entries, log5_entries, min_delta=default_min_delta, max_delta=default_max_delta):
+    # Entries are (datetime, path) tuples. Returns a dict with
+    #   pairs:          [(log4_path, log5_path)] in log4 time order
+    #   unmatched_log4: log4 paths without a log5 inside the window
+    #   unmatched_log5: log5 paths no log4 claimed
+    #   ambiguous:      [(log4_path, [candidate log5 paths])] where more than one log5
+    #                   was inside the window; the earliest free candidate is paired
+    result = {'pairs': [], 'unmatched_log4': [], 'unmatched_log5': [], 'ambiguous': []}
+
+    log4_sorted = sorted(entry for entry in log4_entries if entry[0] is not None)
+    log5_sorted = sorted(entry for entry in log5_entries if entry[0] is not None)
+    result['unmatched_log4'].extend(path for time, path in log4_entries if time is None)
+    result['unmatched_log5'].extend(path for time, path in log5_entries if time is None)
+
+    # log5_sorted[low:high] is the window of still unpaired log5 candidates for the current log4
+    low = 0
+    high = 0
+    for log4_time, log4_path in log4_sorted:
+        while low < len(log5_sorted) and log5_sorted[low][0] < log4_time + min_delta:
+            result['unmatched_log5'].append(log5_sorted[low][1])
+            low += 1
+        high = max(high, low)
+        while high < len(log5_sorted) and log5_sorted[high][0] <= log4_time + max_delta:
+            high += 1
+
+        if low == high:
+            result['unmatched_log4'].append(log4_path)
+            continue
+        if high - low > 1:
+            result['ambiguous'].append((log4_path, [path for _, path in log5_sorted[low:high]]))
+        result['pairs'].append((log4_path, log5_sorted[low][1]))
+        low += 1
+
+    result['unmatched_log5'].extend(path for _, path in log5_sorted[low:])
+    return result
@@ -0,0 +1,155 @@
+import json
+import re
+import hashlib
+from datetime import datetime
+
+# Incremental reader for chat log files. Instead of json.load-ing a whole log,
+# the top-level object is walked key by key and the items of the "users" and
+# "comments" arrays are decoded and yielded one at a time.
+
+chunk_size = 64 * 1024
+whitespace = re.compile(r'[ \t\n\r]*')
+number_tail = re.compile(r'[0-9+\-.eE]*$')
+decoder = json.JSONDecoder()
+
+
+class LogStream(object):
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def refill(self):
+        # Read at least as much as is buffered, so a large value needs only log(n) retries
+        chunk = self.file.read(max(chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            self.pos = whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of log file")
+            self.refill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected {!r} at offset {} of log file".format(char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                self.refill()
+                continue
+            # A number at the end of the buffer may continue in the next chunk ("1." of "1.5e3")
+            if not self.eof and isinstance(value, (int, float)) and number_tail.match(self.buffer, end):
+                self.refill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_log(file, array_keys=('users', 'comments')):
+    # Yields (key, value) for every top-level field of a log, except that the
+    # arrays named in array_keys are yielded as one (key, item) pair per item
+    stream = LogStream(file)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.decode()
+        stream.expect(':')
+        if key in array_keys and stream.peek() == '[':
+            stream.pos += 1
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield key, stream.decode()
+                    if stream.peek() == ']':
+                        stream.pos += 1
+                        break
+                    stream.expect(',')
+        else:
+            yield key, stream.decode()
+        if stream.peek() == '}':
+            return
+        stream.expect(',')
+
+
+def parse_log_time(value):
+    # Times are written by JSON.stringify, e.g. 2024-07-18T09:02:11.482Z; None if missing or malformed
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        try:
+            return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+        except ValueError:
+            return None
+
+
+def comment_bytes(comment):
+    # Canonical encoding, so equal comments hash equally regardless of key order
+    return json.dumps(comment, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def comment_hash(comment):
+    # Stable hash of the fields that identify a comment; replies contribute their own hashes
+    replies = [comment_hash(reply) for reply in comment.get('replies') or []]
+    fields = [comment.get('id'), comment.get('time'), comment.get('userName'), comment.get('content'), replies]
+    return hashlib.blake2b(comment_bytes(fields), digest_size=16).hexdigest()
+
+
+def message_hashes(comment):
+    # Hashes of the comment and of each of its replies, every one without its own replies,
+    # so a later copy of the comment that only gained replies holds all of them
+    fields = [comment.get('id'), comment.get('time'), comment.get('userName'), comment.get('content')]
+    hashes = [hashlib.blake2b(comment_bytes(fields), digest_size=16).hexdigest()]
+    for reply in comment.get('replies') or []:
+        hashes.extend(message_hashes(reply))
+    return hashes
+
+
+def merkle_root(hashes):
+    # Root of a binary hash tree over the comment hashes, in log order
+    level = [bytes.fromhex(value) for value in hashes]
+    if not level:
+        return hashlib.blake2b(b'', digest_size=16).hexdigest()
+    while len(level) > 1:
+        paired = []
+        for i in range(0, len(level) - 1, 2):
+            paired.append(hashlib.blake2b(level[i] + level[i + 1], digest_size=16).digest())
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
+
+
+class CommentsDigest(object):
+    # Collects (id, time, hash, message hashes) of each comment of a log and the log's Merkle digest
+    def __init__(self):
+        self.comments = []
+
+    def update(self, comment):
+        self.comments.append((comment.get('id'), comment.get('time'), comment_hash(comment),
+                              ' '.join(message_hashes(comment))))
+
+    @property
+    def count(self):
+        return len(self.comments)
+
+    def hexdigest(self):
+        return merkle_root([value for _, _, value, _ in self.comments])
@@ -1,75 +1,42 @@
-import os
-import json
 import csv
-from datetime import datetime, timedelta
-import re
+import argparse
+from log_catalog import default_catalog_path, open_catalog, update_catalog, iter_logs
+from participant_index import update_participants, duplicate_pid_names
+from instrumentation import stage, count, add_arguments, instrumented
+from async_io import add_arguments as add_io_arguments
 
-def parse_timestamp(filename):
-    match = re.search(r'_(\d{2}\.\d{2}\.\d{4}-\d{2}\.\d{2})_', filename)
-    if match:
-        return datetime.strptime(match.group(1), "%d.%m.%Y-%H.%M")
-    return None
-
-def find_unique_users(directories, output_txt):
-    unique_users = {}
-    user_file_mapping = {}
-
-    for directory in directories:
-        for filename in os.listdir(directory):
-            if filename.endswith("_log.json"):
-                file_path = os.path.join(directory, filename)
-                with open(file_path, 'r') as file:
-                    data = json.load(file)
-                    for user in data.get("users", []):
-                        pid = user.get("prolificPid")
-                        name = user.get("name")
-                        if pid not in unique_users:
-                            unique_users[pid] = set()
-                            user_file_mapping[pid] = set()
-                        unique_users[pid].add(name)
-                        user_file_mapping[pid].add(filename)
+# Labels used in speaking_stats.txt for the botType values of the room specs
+bot_labels = {'Alex (Moderator)': 'Alex(Moderator)', 'Alex': 'Alex', '': 'null'}
 
+def find_unique_users(directories, output_txt, catalog):
+    # The catalog groups the users of the logs by PID, so only PIDs with several names come back
+    duplicates = duplicate_pid_names(catalog, directories)
+    count('duplicate_pids', len(duplicates))
     with open(output_txt, 'w') as f:
-        for pid, names in unique_users.items():
-            if len(names) > 1:
-                f.write("PID {0} with names {1} appears in files: {2}\n".format(
-                    pid, ', '.join(names), ', '.join(user_file_mapping[pid])
-                ))
+        for pid, names, filenames in duplicates:
+            f.write("PID {0} with names {1} appears in files: {2}\n".format(pid, ', '.join(names), ', '.join(filenames)))
 
-def count_users_in_logs(directories, output_csv, output_txt):
+def count_users_in_logs(directories, output_csv, output_txt, catalog):
     log_stats = []
-    pattern = re.compile(r'pilot_study_(\d+)_\d{2}\.\d{2}\.\d{4}-\d{2}\.\d{2}_(\d)_log\.json')
     user_speaks_count = {}
 
     for directory in directories:
-        for filename in os.listdir(directory):
-            if filename.endswith("_log.json"):
-                match = pattern.match(filename)
-                if match and match.group(2) == '4':  # Only process log version 4
-                    room_id = int(match.group(1))
-                    timestamp = parse_timestamp(filename)
-                    file_path = os.path.join(directory, filename)
-                    with open(file_path, 'r') as file:
-                        data = json.load(file)
-                        name_to_pid = {user["name"]: user["prolificPid"] for user in data.get("users", [])}
-                        user_speaks = {pid: False for pid in name_to_pid.values()}
-
-                        for comment in data.get("comments", []):
-                            if comment["userName"] in name_to_pid:
-                                user_speaks[name_to_pid[comment["userName"]]] = True
+        for log in iter_logs(catalog, [directory], versions=[4]):  # Only process log version 4
+            if not log["spec"].startswith("pilot_study_") or log["num_users"] is None:
+                continue
+            num_users_speak = log["num_users_speak"]
+            user_speaks_count.setdefault(num_users_speak, []).append(log)
 
-                        num_users_speak = sum(user_speaks.values())
-                        user_speaks_count.setdefault(num_users_speak, []).append(filename)
+            log_stats.append({
+                "room_id": log["room_id"],
+                "timestamp": log["timestamp"],
+                "num_users": log["num_users"],
+                "num_users_speak": num_users_speak,
+                "file": log["filename"]
+            })
 
-                        log_stats.append({
-                            "room_id": room_id,
-                            "timestamp": timestamp,
-                            "num_users": len(name_to_pid),
-                            "num_users_speak": num_users_speak,
-                            "file": filename
-                        })
-
-    with open(output_csv, 'wb') as csvfile:
+    count('pilot_logs', len(log_stats))
+    with open(output_csv, 'w', newline='') as csvfile:
         fieldnames = ['room_id', 'num_users', 'num_users_speak', 'timestamp', 'file']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
@@ -77,30 +44,46 @@ def count_users_in_logs(directories, output_csv, output_txt):
             writer.writerow(log)
 
     with open(output_txt, 'w') as f:
-        for count, files in user_speaks_count.items():
-            f.write("Rooms with {0} users speaking: {1}\n".format(count, len(files)))
+        for num_users_speak, files in user_speaks_count.items():
+            f.write("Rooms with {0} users speaking: {1}\n".format(num_users_speak, len(files)))
             bot_counts = {'Alex': 0, 'Alex(Moderator)': 0, 'null': 0}
-            for file in files:
-                room_id = int(file.split('_')[2])
-                bot_type = 'Alex(Moderator)' if room_id % 3 == 1 else 'Alex' if room_id % 3 == 2 else 'null'
-                bot_counts[bot_type] += 1
-            f.write("Bot counts for {0} users speaking: {1}\n".format(count, bot_counts))
+            for log in files:
+                # The bot type is the one the room actually ran with, as recorded in the log
+                bot_type = bot_labels.get(log["bot_type"] or "", log["bot_type"])
+                bot_counts[bot_type] = bot_counts.get(bot_type, 0) + 1
+            f.write("Bot counts for {0} users speaking: {1}\n".format(num_users_speak, bot_counts))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count speaking users and duplicate PIDs across chat logs.")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes for parsing new logs")
+    add_arguments(parser)
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    directories = [
+        '/srv/chat-room/chat-room.git/chatlog_07_19_morning',
+        '/srv/chat-room/chat-room.git/chatlog_07_19_afternoon',
+        '/srv/chat-room/chat-room.git/chatlog_07_18_morning',
+        '/srv/chat-room/chat-room.git/chatlog_07_18_afternoon',
+        '/srv/chat-room/chat-room.git/chatlog_07_22',
+        '/srv/chat-room/chat-room.git/chatlog_07_23',
+        '/srv/chat-room/chat-room.git/chatlog_07_17',
+        ]
+    output_csv = '/srv/chat-room/server/private/chatLogs/log_statistics.csv'
+    output_txt = '/srv/chat-room/server/private/chatLogs/speaking_stats.txt'
+    output_users_txt = '/srv/chat-room/server/private/chatLogs/duplicate_usernames.txt'
 
-directories = [
-    '/srv/chat-room/chat-room.git/chatlog_07_19_morning',
-    '/srv/chat-room/chat-room.git/chatlog_07_19_afternoon',
-    '/srv/chat-room/chat-room.git/chatlog_07_18_morning',
-    '/srv/chat-room/chat-room.git/chatlog_07_18_afternoon',
-    '/srv/chat-room/chat-room.git/chatlog_07_22',
-    '/srv/chat-room/chat-room.git/chatlog_07_23',
-    '/srv/chat-room/chat-room.git/chatlog_07_17',
-    ]
-output_csv = '/srv/chat-room/server/private/chatLogs/log_statistics.csv'
-output_txt = '/srv/chat-room/server/private/chatLogs/speaking_stats.txt'
-output_users_txt = '/srv/chat-room/server/private/chatLogs/duplicate_usernames.txt'
+    with instrumented(args, 'log_statistics'):
+        # Bring the catalog up to date; only new or changed logs are read
+        catalog = open_catalog(default_catalog_path)
+        update_catalog(catalog, directories, args.jobs, args.io_concurrency)
+        # and the participant index with it (see participant_index.py)
+        update_participants(catalog)
 
-# First, find unique users and note duplicates across all directories
-find_unique_users(directories, output_users_txt)
+        # First, find unique users and note duplicates across all directories
+        with stage('duplicates'):
+            find_unique_users(directories, output_users_txt, catalog)
 
-# Then, process logs to gather statistics and speaking counts
-count_users_in_logs(directories, output_csv, output_txt)
+        # Then, process logs to gather statistics and speaking counts
+        with stage('statistics'):
+            count_users_in_logs(directories, output_csv, output_txt, catalog)
@@ -1,133 +1,239 @@
 import os
 import json
 import csv
-import re
-from datetime import datetime, timedelta
-from collections import OrderedDict
-
-def parse_datetime_from_filename(filename):
-    match = re.search(r'(\d{2}\.\d{2}\.\d{4}-\d{2}\.\d{2})', filename)
-    if match:
-        return datetime.strptime(match.group(1), '%d.%m.%Y-%H.%M')
-    return None
-
-def get_room_id_from_filename(filename):
-    match = re.search(r'pilot_study_(\d+)_', filename)
-    if match:
-        return int(match.group(1))
-    return None
+import argparse
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from log_catalog import default_catalog_path, open_catalog, update_catalog, iter_logs, log_comment_hashes, log_offsets
+from log_dedup import contains, reconstruct_union
+from log_pairing import default_min_delta, default_max_delta, pair_logs
+from log_names import parse_timestamp
+from instrumentation import stage, count, collect, merge, add_arguments, instrumented
+from async_io import bounded_map, add_arguments as add_io_arguments
 
 def load_json_ordered(filename):
+    # Plain dicts keep the key order of the file, so no OrderedDict tree is needed
     with open(filename, 'r') as f:
-        return json.load(f, object_pairs_hook=OrderedDict)
+        return json.load(f)
 
-def process_directory(directory, output_dir, comparison_data, log_count_filename):
+def collect_directory_logs(catalog, directory):
     log4_files = {}
     log5_files = {}
-    missing_log5_files = []
+    log_info = {}
 
-    # Step 1: Collect all log4 and log5 files
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('_4_log.json'):
-                room_id = get_room_id_from_filename(file)
-                if room_id not in log4_files:
-                    log4_files[room_id] = []
-                log4_files[room_id].append(os.path.join(root, file))
-            elif file.endswith('_5_log.json'):
-                room_id = get_room_id_from_filename(file)
-                if room_id not in log5_files:
-                    log5_files[room_id] = []
-                log5_files[room_id].append(os.path.join(root, file))
-
-    # Write the count of log4 and log5 files to a text file
-    with open(log_count_filename, 'a') as f:
-        f.write("Directory: {}\n".format(directory))
-        f.write("Number of log4 files: {}\n".format(sum(len(v) for v in log4_files.values())))
-        f.write("Number of log5 files: {}\n".format(sum(len(v) for v in log5_files.values())))
-
-    # Step 2: Find matching log5 for each log4 by room_id and timestamp difference
-    for room_id in log4_files:
-        if room_id not in log5_files:
-            missing_log5_files.extend(log4_files[room_id])
-            continue
-
-        for log4_path in log4_files[room_id]:
-            log4_datetime = parse_datetime_from_filename(log4_path)
-            timestamp = log4_datetime.strftime('%Y-%m-%d %H:%M:%S') if log4_datetime else 'null'
-            corresponding_log5 = None
-
-            for log5_path in log5_files[room_id]:
-                log5_datetime = parse_datetime_from_filename(log5_path)
-                if log4_datetime and log5_datetime and log5_datetime - log4_datetime in (timedelta(minutes=1), timedelta(minutes=2)):
-                    corresponding_log5 = log5_path
-                    break
-
-            if not corresponding_log5:
-                missing_log5_files.append(log4_path)
-                continue
-
-            log4_data, log5_data = None, None
-            if log4_path:
-                log4_data = load_json_ordered(log4_path)
-                print("Loaded log4 data for {}: {}".format(log4_path, json.dumps(log4_data, indent=2)))  # Debug print
-
-            if corresponding_log5:
-                log5_data = load_json_ordered(corresponding_log5)
-                print("Loaded log5 data for {}: {}".format(corresponding_log5, json.dumps(log5_data, indent=2)))  # Debug print
-
-            if log4_data and log5_data:
-                log4_comments = log4_data.get('comments', [])
-                log5_comments = log5_data.get('comments', [])
-
-                if log4_comments != log5_comments:
-                    log4_len = len(log4_comments)
-                    log5_len = len(log5_comments)
-                    if log4_len > log5_len:
-                        full_log = log4_data
-                        full_log_filename = log4_path
-                        longer_log = 'log4'
-                    else:
-                        full_log = log5_data
-                        full_log_filename = corresponding_log5
-                        longer_log = 'log5'
-                else:
-                    # If they are the same, select log4 as the full log
-                    full_log = log4_data
-                    full_log_filename = log4_path
+    # Collect all log4 and log5 files with their timestamps, parsed once per file,
+    # and the comment digests recorded by the catalog. Rooms are keyed by (spec, room_id),
+    # as studies with different names can share room numbers
+    for log in iter_logs(catalog, [directory], versions=[4, 5], recursive=True):
+        files = log4_files if log['version'] == 4 else log5_files
+        room_key = (log['spec'], log['room_id'])
+        if room_key not in files:
+            files[room_key] = []
+        files[room_key].append((parse_timestamp(log['timestamp']), log['path']))
+        log_info[log['path']] = (log['timestamp'], log['comments_digest'], log['num_comments'])
+
+    # Per-comment hashes let a pair be compared and merged without reading either file;
+    # the byte ranges let a union decode only the comments it takes from each log
+    hashes = log_comment_hashes(catalog, list(log_info))
+    for path in log_info:
+        log_info[path] += (hashes[path], log_offsets(catalog, path))
+
+    return log4_files, log5_files, log_info
+
+def build_full_log(sources, hashes, offsets=None):
+    if len(sources) == 1:
+        return load_json_ordered(sources[0])
+    return reconstruct_union(sources, hashes, offsets)
+
+def write_full_log(output_path, sources, hashes, offsets=None):
+    with stage('merge'):
+        full_log = build_full_log(sources, hashes, offsets)
+    with stage('write'):
+        with open(output_path, 'w') as f:
+            json.dump(full_log, f, indent=2)
+
+def compare_room(room_id, log4_entries, log5_entries, log_info, output_dir, min_delta, max_delta, verbose=False,
+                 write=True):
+    # Pairs the logs of one room, writes the selected full logs and returns the rows
+    # for the comparison CSV; runs in a worker process when --jobs is above 1. With
+    # write=False the full logs are only listed in the result, for the caller to write
+    result = {'comparison_rows': [], 'full_logs': []}
+    with stage('pair'):
+        pairing = pair_logs(log4_entries, log5_entries, min_delta, max_delta)
+    result['unmatched_log4'] = pairing['unmatched_log4']
+    result['unmatched_log5'] = pairing['unmatched_log5']
+    result['ambiguous'] = pairing['ambiguous']
+    count('pairs_matched', sum(1 for log4_path, log5_path in pairing['pairs'] if log4_path and log5_path))
+    count('log4_unmatched', len(pairing['unmatched_log4']))
+    count('log5_unmatched', len(pairing['unmatched_log5']))
+    count('pairs_ambiguous', len(pairing['ambiguous']))
+
+    for log4_path, corresponding_log5 in pairing['pairs']:
+        timestamp, log4_digest, log4_len, log4_hashes, _ = log_info[log4_path]
+        _, log5_digest, log5_len, log5_hashes, _ = log_info[corresponding_log5]
+
+        if verbose:
+            print("Loaded log4 data for {}: {}".format(log4_path, json.dumps(load_json_ordered(log4_path), indent=2)))
+            print("Loaded log5 data for {}: {}".format(corresponding_log5, json.dumps(load_json_ordered(corresponding_log5), indent=2)))
+
+        # Logs the catalog could not read have no digest
+        if log4_digest and log5_digest:
+            with stage('compare'):
+                if log4_digest == log5_digest or contains(log4_hashes, log5_hashes):
+                    # If they are the same, or log5 adds nothing, select log4 as the full log
+                    sources = (log4_path,)
                     longer_log = 'log4'
+                elif contains(log5_hashes, log4_hashes):
+                    sources = (corresponding_log5,)
+                    longer_log = 'log5'
+                else:
+                    # Each log holds comments the other lacks: rebuild the session from both
+                    sources = (log4_path, corresponding_log5)
+                    longer_log = 'union'
+
+            # Ensure full log retains the original structure including users
+            full_log_output_path = os.path.join(output_dir, os.path.basename(sources[-1]).replace('_log', '_full_log'))
+            source_hashes = {path: log_info[path][3] for path in sources}
+            source_offsets = {path: log_info[path][4] for path in sources}
+            if write:
+                write_full_log(full_log_output_path, sources, source_hashes, source_offsets)
+            result['full_logs'].append((full_log_output_path, sources, source_hashes, source_offsets))
+            count('full_logs_' + longer_log)
+
+            result['comparison_rows'].append([
+                room_id,
+                timestamp,
+                log4_path,
+                corresponding_log5,
+                'Different' if log4_digest != log5_digest else 'Same',
+                longer_log
+            ])
+        else:
+            result['comparison_rows'].append([
+                room_id,
+                timestamp,
+                log4_path if log4_path else 'null',
+                corresponding_log5 if corresponding_log5 else 'null',
+                'Missing log4 or log5',
+                'null'
+            ])
+
+    return result
+
+def run_room_task(task):
+    # The metrics of the task travel back with its result, as it may run in a worker process
+    with collect() as metrics:
+        result = compare_room(*task)
+    result['metrics'] = metrics.as_dict()
+    return result
 
-                # Ensure full log retains the original structure including users
-                full_log_output_path = os.path.join(output_dir, os.path.basename(full_log_filename).replace('_log', '_full_log'))
-                with open(full_log_output_path, 'w') as f:
-                    json.dump(full_log, f, indent=2)
-
-                # Check for duplicates in comparison_data
-                entry = [
-                    room_id,
-                    timestamp,
-                    log4_path,
-                    corresponding_log5,
-                    'Different' if log4_comments != log5_comments else 'Same',
-                    longer_log
-                ]
-                if entry not in comparison_data:
-                    comparison_data.append(entry)
-            else:
-                comparison_data.append([
-                    room_id,
-                    timestamp,
-                    log4_path if log4_path else 'null',
-                    corresponding_log5 if corresponding_log5 else 'null',
-                    'Missing log4 or log5',
-                    'null'
-                ])
-
-    # Write missing log5 files to the same log count file
+def merge_room_metrics(room_results):
+    for result in room_results:
+        merge(result.pop('metrics'))
+
+def write_directory_results(directory, log4_files, log5_files, room_results, comparison_data, log_count_filename,
+                            pairing_report):
+    missing_log5_files = []
+    unmatched_log5_files = []
+    ambiguous_pairs = []
+
+    for room_key in log5_files:
+        if room_key not in log4_files:
+            unmatched_log5_files.extend(path for _, path in sorted(log5_files[room_key]))
+
+    for result in room_results:
+        missing_log5_files.extend(result['unmatched_log4'])
+        unmatched_log5_files.extend(result['unmatched_log5'])
+        ambiguous_pairs.extend(result['ambiguous'])
+        for entry in result['comparison_rows']:
+            # Check for duplicates in comparison_data
+            if entry not in comparison_data:
+                comparison_data.append(entry)
+
+    # Write the count of log4 and log5 files, and the log4 files missing their log5, to a
+    # text file; the lines of a directory are appended with one write
+    lines = [
+        "Directory: {}\n".format(directory),
+        "Number of log4 files: {}\n".format(sum(len(v) for v in log4_files.values())),
+        "Number of log5 files: {}\n".format(sum(len(v) for v in log5_files.values())),
+        "\nLog4 files without corresponding log5 files:\n",
+    ]
+    lines.extend("{}\n".format(log4_path) for log4_path in missing_log5_files)
     with open(log_count_filename, 'a') as f:
-        f.write("\nLog4 files without corresponding log5 files:\n")
-        for log4_path in missing_log5_files:
-            f.write("{}\n".format(log4_path))
+        f.write(''.join(lines))
+
+    if pairing_report is not None:
+        pairing_report.append({
+            'directory': directory,
+            'unmatched_log4': missing_log5_files,
+            'unmatched_log5': unmatched_log5_files,
+            'ambiguous': [{'log4': log4_path, 'log5_candidates': candidates} for log4_path, candidates in ambiguous_pairs],
+        })
+
+def write_room_full_logs(room_results, io_concurrency):
+    # Writes the full logs listed by rooms compared with write=False, many at a time;
+    # a path listed twice gets its last sources, as in a serial run
+    latest = {}
+    for result in room_results:
+        for output_path, sources, source_hashes, source_offsets in result['full_logs']:
+            latest[output_path] = (sources, source_hashes, source_offsets)
+    bounded_map(lambda item: write_full_log(item[0], *item[1]), latest.items(), io_concurrency)
+
+def process_directories(directories, output_dir, comparison_data, log_count_filename, catalog=None, jobs=1,
+                        min_delta=default_min_delta, max_delta=default_max_delta, pairing_report=None, verbose=False,
+                        io_concurrency=0):
+    if catalog is None:
+        catalog = open_catalog(':memory:')
+    update_catalog(catalog, directories, jobs, io_concurrency)
+
+    # With io_concurrency and a single process, the rooms are only compared here (from the
+    # catalog) and the full logs are read, merged and written afterwards, many at a time
+    deferred = io_concurrency > 1 and jobs <= 1
+
+    # One task per room; rooms are independent, so they can be compared in any process
+    tasks = []
+    directory_logs = []
+    for directory in directories:
+        log4_files, log5_files, log_info = collect_directory_logs(catalog, directory)
+        for room_key in log4_files:
+            room_entries = log4_files[room_key] + log5_files.get(room_key, [])
+            room_info = {path: log_info[path] for _, path in room_entries}
+            tasks.append((room_key[1], log4_files[room_key], log5_files.get(room_key, []), room_info,
+                          output_dir, min_delta, max_delta, verbose, not deferred))
+        directory_logs.append((directory, log4_files, log5_files))
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            room_results = list(executor.map(run_room_task, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+    else:
+        room_results = [run_room_task(task) for task in tasks]
+    merge_room_metrics(room_results)
+
+    # Results come back in task order, so merging them here matches a serial run
+    written_full_logs = {}
+    position = 0
+    for directory, log4_files, log5_files in directory_logs:
+        results = room_results[position:position + len(log4_files)]
+        position += len(log4_files)
+        write_directory_results(directory, log4_files, log5_files, results, comparison_data, log_count_filename,
+                                pairing_report)
+        for result in results:
+            for output_path, sources, source_hashes, source_offsets in result['full_logs']:
+                written_full_logs.setdefault(output_path, []).append((sources, source_hashes, source_offsets))
+
+    # Several directories can produce the same full log name; a serial run keeps the last one
+    if deferred:
+        write_room_full_logs(room_results, io_concurrency)
+    elif jobs > 1:
+        for output_path, writes in written_full_logs.items():
+            if len(set(sources for sources, _, _ in writes)) > 1:
+                with open(output_path, 'w') as f:
+                    json.dump(build_full_log(*writes[-1]), f, indent=2)
+
+def process_directory(directory, output_dir, comparison_data, log_count_filename, catalog=None,
+                      min_delta=default_min_delta, max_delta=default_max_delta, pairing_report=None, verbose=False):
+    process_directories([directory], output_dir, comparison_data, log_count_filename, catalog, 1,
+                        min_delta, max_delta, pairing_report, verbose)
 
 def make_sure_path_exists(path):
     try:
@@ -137,10 +243,20 @@ def make_sure_path_exists(path):
             raise
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pair log4/log5 files and write the full logs.")
+    parser.add_argument('--min-delta', type=int, default=1, help="minimum minutes between a log4 and its log5")
+    parser.add_argument('--max-delta', type=int, default=2, help="maximum minutes between a log4 and its log5")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--verbose', action='store_true', help="print every paired log in full")
+    add_arguments(parser)
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
     base_directory = '/srv/chat-room/chat-room.git/' # the base directory containing the chatlog directories
     output_directory = '/srv/chat-room/chat-room.git/full_logs/'
     comparison_csv = '/srv/chat-room/chat-room.git/comparison.csv'
     log_count_txt = '/srv/chat-room/chat-room.git/log_counts.txt'
+    pairing_report_json = '/srv/chat-room/chat-room.git/pairing_report.json'
 
     # Ensure the output directory exists
     make_sure_path_exists(output_directory)
@@ -156,15 +272,24 @@ if __name__ == "__main__":
 
     # Initialize comparison data list
     comparison_data = []
+    pairing_report = []
+    catalog = open_catalog(default_catalog_path)
+
+    with instrumented(args, 'merge_log'):
+        print("Processing directories: {}".format(', '.join(directories_to_process)))
+        process_directories([os.path.join(base_directory, directory) for directory in directories_to_process],
+                            output_directory, comparison_data, log_count_txt, catalog, args.jobs,
+                            timedelta(minutes=args.min_delta), timedelta(minutes=args.max_delta), pairing_report, args.verbose,
+                            args.io_concurrency)
 
-    for directory in directories_to_process:
-        print("Processing directory: {}".format(directory))
-        process_directory(os.path.join(base_directory, directory), output_directory, comparison_data, log_count_txt)
+        # Unmatched and ambiguous pairs per directory, for follow-up by hand
+        with open(pairing_report_json, 'w') as f:
+            json.dump(pairing_report, f, indent=2)
 
-    # Write comparison data to CSV after processing all directories
-    with open(comparison_csv, 'wb') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(['Room ID', 'Timestamp', 'Log4 Filename', 'Log5 Filename', 'Different?', 'Selected Log'])
-        csvwriter.writerows(comparison_data)
+        # Write comparison data to CSV after processing all directories
+        with open(comparison_csv, 'w', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(['Room ID', 'Timestamp', 'Log4 Filename', 'Log5 Filename', 'Different?', 'Selected Log'])
+            csvwriter.writerows(comparison_data)
 
     print("Processing completed.")
@@ -0,0 +1,184 @@
+import json
+import argparse
+from log_catalog import default_catalog_path, open_catalog, update_catalog, directory_filter, catalog_directory
+
+# Index of the participants of every room session, kept in the log catalog:
+# one row per Prolific PID, name and session with the room, bot type and how
+# many comments the participant wrote (the most any log of the session shows).
+# update_participants refreshes only the sessions whose logs changed since the
+# last update, as the catalog lists them in log_changes, so screening a new
+# study's participants against all earlier ones, or checking names and silent
+# participants, needs no pass over the logs.
+
+schema = """
+CREATE TABLE IF NOT EXISTS participant_sessions (
+    prolific_pid TEXT NOT NULL,
+    name TEXT,
+    spec TEXT NOT NULL,
+    room_id INTEGER,
+    session_start TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    bot_type TEXT,
+    num_comments INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS participant_index_state (
+    spec TEXT NOT NULL,
+    session_start TEXT NOT NULL,
+    PRIMARY KEY (spec, session_start)
+);
+CREATE INDEX IF NOT EXISTS participant_sessions_pid ON participant_sessions (prolific_pid);
+CREATE INDEX IF NOT EXISTS participant_sessions_session ON participant_sessions (spec, session_start);
+"""
+
+
+def open_participant_index(conn):
+    conn.executescript(schema)
+    return conn
+
+
+def refresh_session(conn, spec, session_start):
+    conn.execute("DELETE FROM participant_sessions WHERE spec = ? AND session_start = ?", (spec, session_start))
+    # Copies of a session in several directories count once
+    conn.execute(
+        "INSERT INTO participant_sessions "
+        "SELECT log_users.prolific_pid, log_users.name, logs.spec, MIN(logs.room_id), logs.session_start, "
+        "MIN(logs.directory), MAX(logs.bot_type), MAX(log_users.num_comments) "
+        "FROM logs JOIN log_users USING (path) "
+        "WHERE logs.spec = ? AND logs.session_start = ? AND logs.kind = 'log' AND log_users.prolific_pid IS NOT NULL "
+        "GROUP BY log_users.prolific_pid, log_users.name", (spec, session_start))
+
+
+def update_participants(conn):
+    # Brings the index up to date with the catalog; run after update_catalog
+    open_participant_index(conn)
+    summary = {'refreshed': 0, 'removed': 0}
+    if conn.execute("SELECT 1 FROM participant_index_state LIMIT 1").fetchone() is None:
+        # A new index takes every session of the catalog
+        changed = conn.execute(
+            "SELECT DISTINCT spec, session_start FROM logs WHERE kind = 'log' AND session_start IS NOT NULL").fetchall()
+    else:
+        changed = conn.execute("SELECT spec, session_start FROM log_changes").fetchall()
+    for spec, session_start in changed:
+        refresh_session(conn, spec, session_start)
+        if conn.execute("SELECT 1 FROM logs WHERE spec = ? AND session_start = ? AND kind = 'log' LIMIT 1",
+                        (spec, session_start)).fetchone() is not None:
+            conn.execute("INSERT OR IGNORE INTO participant_index_state VALUES (?, ?)", (spec, session_start))
+            summary['refreshed'] += 1
+        else:
+            # None of the session's logs are left
+            conn.execute("DELETE FROM participant_index_state WHERE spec = ? AND session_start = ?", (spec, session_start))
+            summary['removed'] += 1
+    conn.execute("DELETE FROM log_changes")
+    conn.commit()
+    return summary
+
+
+def repeat_participants(conn, min_sessions=2):
+    # [(pid, number of sessions, names)] of participants who took part in several sessions
+    return [(row['prolific_pid'], row['sessions'], sorted(json.loads(row['names'])))
+            for row in conn.execute(
+                "SELECT prolific_pid, COUNT(DISTINCT spec || char(1) || session_start) AS sessions, "
+                "json_group_array(DISTINCT name) AS names FROM participant_sessions "
+                "GROUP BY prolific_pid HAVING sessions >= ? ORDER BY sessions DESC, prolific_pid", (min_sessions,))]
+
+
+def pids_with_several_names(conn):
+    # [(pid, names)] of participants known under more than one name
+    return [(row['prolific_pid'], sorted(json.loads(row['names'])))
+            for row in conn.execute(
+                "SELECT prolific_pid, json_group_array(DISTINCT name) AS names FROM participant_sessions "
+                "GROUP BY prolific_pid HAVING COUNT(DISTINCT name) > 1 ORDER BY prolific_pid")]
+
+
+def shared_names(conn):
+    # [(spec, session_start, name, pids)] where participants of one session shared a name; their
+    # comments cannot be told apart, as comments carry only the name
+    return [(row['spec'], row['session_start'], row['name'], sorted(json.loads(row['pids'])))
+            for row in conn.execute(
+                "SELECT spec, session_start, name, json_group_array(DISTINCT prolific_pid) AS pids "
+                "FROM participant_sessions GROUP BY spec, session_start, name "
+                "HAVING COUNT(DISTINCT prolific_pid) > 1 ORDER BY spec, session_start, name")]
+
+
+def silent_participants(conn):
+    # [(pid, number of sessions)] of participants who never wrote a comment in any session
+    return [(row['prolific_pid'], row['sessions'])
+            for row in conn.execute(
+                "SELECT prolific_pid, COUNT(DISTINCT spec || char(1) || session_start) AS sessions "
+                "FROM participant_sessions GROUP BY prolific_pid HAVING MAX(num_comments) = 0 ORDER BY prolific_pid")]
+
+
+def screen_participants(conn, pids):
+    # {pid: [sessions]} for the pids that took part in an earlier session
+    seen = {}
+    pids = list(pids)
+    for start in range(0, len(pids), 500):
+        batch = pids[start:start + 500]
+        for row in conn.execute(
+                "SELECT * FROM participant_sessions WHERE prolific_pid IN ({}) ORDER BY session_start, spec".format(
+                    ', '.join('?' * len(batch))), batch):
+            seen.setdefault(row['prolific_pid'], []).append(row)
+    return seen
+
+
+def duplicate_pid_names(conn, directories, kinds=('log', 'full')):
+    # [(pid, names, filenames)] of the pids with several names in the logs of the directories, in
+    # the order each pid first appears (directories in the given order, then file and position)
+    if not directories:
+        return []
+    where, params = directory_filter(directories)
+    rank = "CASE logs.directory {} END".format(' '.join('WHEN ? THEN {}'.format(i) for i in range(len(directories))))
+    query = (
+        "SELECT log_users.prolific_pid AS pid, json_group_array(DISTINCT log_users.name) AS names, "
+        "json_group_array(DISTINCT logs.filename) AS files, "
+        "MIN(printf('%06d', " + rank + ") || char(1) || logs.filename || char(1) || printf('%06d', log_users.position)) "
+        "AS first_seen FROM log_users JOIN logs USING (path) WHERE " + where +
+        " AND kind IN ({})".format(', '.join('?' * len(kinds))) +
+        " GROUP BY log_users.prolific_pid HAVING COUNT(DISTINCT log_users.name) > 1 ORDER BY first_seen")
+    rank_params = [catalog_directory(directory) for directory in directories]
+    rows = conn.execute(query, rank_params + params + list(kinds))
+    return [(row['pid'], sorted(json.loads(row['names'])), sorted(json.loads(row['files']))) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the participants of all cataloged room sessions.")
+    parser.add_argument('--directories', nargs='*', default=[], help="chatlog directories to catalog first")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('update', help="only bring the index up to date")
+    repeat_command = commands.add_parser('repeat', help="participants of several sessions")
+    repeat_command.add_argument('--min-sessions', type=int, default=2)
+    commands.add_parser('names', help="participants with several names, and names shared within a session")
+    commands.add_parser('silent', help="participants who never wrote a comment")
+    lookup_command = commands.add_parser('lookup', help="sessions of the given participants")
+    lookup_command.add_argument('pids', nargs='+')
+    screen_command = commands.add_parser('screen', help="participants of a file (one PID per line) seen before")
+    screen_command.add_argument('pid_file')
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    if args.directories:
+        update_catalog(catalog, args.directories)
+    summary = update_participants(catalog)
+
+    if args.command == 'update':
+        print("Participant index: {}".format(summary))
+    elif args.command == 'repeat':
+        for pid, sessions, names in repeat_participants(catalog, args.min_sessions):
+            print("{}\t{}\t{}".format(pid, sessions, ', '.join(names)))
+    elif args.command == 'names':
+        for pid, names in pids_with_several_names(catalog):
+            print("PID {} has names {}".format(pid, ', '.join(names)))
+        for spec, session_start, name, pids in shared_names(catalog):
+            print("{} {}: name {} used by {}".format(spec, session_start, name, ', '.join(pids)))
+    elif args.command == 'silent':
+        for pid, sessions in silent_participants(catalog):
+            print("{}\t{}".format(pid, sessions))
+    else:
+        if args.command == 'lookup':
+            pids = args.pids
+        else:
+            with open(args.pid_file, 'r') as f:
+                pids = [line.strip() for line in f if line.strip()]
+        for pid, rows in sorted(screen_participants(catalog, pids).items()):
+            for row in rows:
+                print("{}\t{}\t{}\t{}\t{}".format(pid, row['name'], row['spec'], row['session_start'], row['num_comments']))
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import shutil
+
+# Renames planned in full before any file is touched. A script adds every
+# (source, destination) move to a RenamePlan, the plan is checked for
+# collisions, and only then applied. A journal written next to the directory
+# records the moves, so an interrupted run is resumed (or rolled back) by
+# comparing the journal with the files on disk. The journal also keeps the
+# modification times of the directories that were listed; while they are
+# unchanged a re-run is a no-op without listing the directory again.
+
+# Changes closer together than this may share a directory modification time
+mtime_resolution = 0.05
+
+
+def journal_path_for(directory, task):
+    # Next to the directory rather than inside it, so writing it does not change the directory
+    return '{}.{}.journal.json'.format(os.path.normpath(directory), task)
+
+
+def settled_mtime(directory):
+    # Waits until any change made after this call gets a later modification time
+    while True:
+        mtime = os.stat(directory).st_mtime_ns
+        wait = mtime / 1e9 + mtime_resolution - time.time()
+        if wait <= 0:
+            return mtime
+        time.sleep(wait)
+
+
+class RenamePlan(object):
+    def __init__(self):
+        self.operations = []
+        # directory -> (mtime, names) of every directory listed while planning
+        self.listed = {}
+
+    def listdir(self, directory):
+        directory = os.path.normpath(directory)
+        mtime = settled_mtime(directory)
+        names = os.listdir(directory)
+        self.listed[directory] = (mtime, set(names))
+        return names
+
+    def add(self, source, destination):
+        source, destination = os.path.normpath(source), os.path.normpath(destination)
+        if source != destination:
+            self.operations.append((source, destination))
+
+    def validate(self):
+        # Replays the moves over the files on disk: each source must be there and each
+        # destination free at the point its move runs
+        problems = []
+        present = {}
+        for source, destination in self.operations:
+            if not present.get(source, os.path.exists(source)):
+                problems.append("{} does not exist when it is moved".format(source))
+            if present.get(destination, os.path.exists(destination)):
+                problems.append("{} already exists when {} is moved there".format(destination, source))
+            present[source] = False
+            present[destination] = True
+        if problems:
+            raise ValueError("Rename plan has collisions:\n" + "\n".join(problems))
+
+    def expected_names(self):
+        # Names each listed directory should hold once the plan is applied
+        expected = dict((directory, set(names)) for directory, (_, names) in self.listed.items())
+        for source, destination in self.operations:
+            if os.path.dirname(source) in expected:
+                expected[os.path.dirname(source)].discard(os.path.basename(source))
+            if os.path.dirname(destination) in expected:
+                expected[os.path.dirname(destination)].add(os.path.basename(destination))
+        return expected
+
+
+def read_journal(journal_path):
+    if not os.path.exists(journal_path):
+        return None
+    with open(journal_path, 'r') as f:
+        return json.load(f)
+
+
+def write_journal(journal_path, journal):
+    temp_path = journal_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(journal, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, journal_path)
+
+
+def move(source, destination):
+    # Moves that already happened are skipped, so an interrupted run can be repeated
+    if not os.path.exists(source):
+        return False
+    if os.path.exists(destination):
+        raise ValueError("Cannot move {}: {} already exists".format(source, destination))
+    shutil.move(source, destination)
+    return True
+
+
+def apply_operations(operations):
+    moved = 0
+    for source, destination in operations:
+        if move(source, destination):
+            moved += 1
+    return moved
+
+
+def unchanged_since(journal):
+    if not journal or journal['status'] != 'complete' or not journal.get('directories'):
+        return False
+    for directory, mtime in journal['directories'].items():
+        if mtime is None or not os.path.isdir(directory) or os.stat(directory).st_mtime_ns != mtime:
+            return False
+    return True
+
+
+def directory_state(plan):
+    # Modification times to trust on the next run; a directory whose contents are
+    # not what the plan left behind (e.g. a file arrived meanwhile) is listed again
+    state = {}
+    for directory, names in plan.expected_names().items():
+        mtime = settled_mtime(directory)
+        state[directory] = mtime if set(os.listdir(directory)) == names else None
+    return state
+
+
+def run_plan(directory, task, make_plan, dry_run=False, journal_path=None):
+    # make_plan(plan, directory) lists the directory through the plan and adds the moves.
+    # Returns the planned (source, destination) moves
+    if not os.path.isdir(directory):
+        print("Directory does not exist:", directory)
+        return []
+    journal_path = journal_path or journal_path_for(directory, task)
+    journal = read_journal(journal_path)
+
+    if journal and journal['status'] == 'applying':
+        if dry_run:
+            print("{}: an interrupted run of {} moves would be resumed first".format(task, len(journal['operations'])))
+        else:
+            moved = apply_operations(journal['operations'])
+            journal['status'] = 'complete'
+            journal['directories'] = {}
+            write_journal(journal_path, journal)
+            print("{}: resumed an interrupted run, {} files moved".format(task, moved))
+    elif unchanged_since(journal):
+        print("{}: {} is unchanged since the last run".format(task, directory))
+        return []
+
+    plan = RenamePlan()
+    make_plan(plan, directory)
+    plan.validate()
+
+    if dry_run:
+        for source, destination in plan.operations:
+            print("Would move {} to {}".format(source, destination))
+        return plan.operations
+
+    if plan.operations:
+        journal = {'task': task, 'directory': directory, 'status': 'applying',
+                   'operations': plan.operations, 'directories': {}}
+        write_journal(journal_path, journal)
+        apply_operations(plan.operations)
+    elif journal is None:
+        journal = {'task': task, 'directory': directory, 'operations': []}
+    # With nothing to move the journal keeps the moves of the last run, for rollback
+    journal['status'] = 'complete'
+    journal['directories'] = directory_state(plan)
+    write_journal(journal_path, journal)
+    print("{}: moved {} files".format(task, len(plan.operations)))
+    return plan.operations
+
+
+def rollback(directory, task, journal_path=None):
+    # Moves the files of the last run back, in reverse order
+    journal_path = journal_path or journal_path_for(directory, task)
+    journal = read_journal(journal_path)
+    if not journal or journal['status'] == 'rolled_back':
+        print("{}: nothing to roll back".format(task))
+        return 0
+    moved = apply_operations([(destination, source) for source, destination in reversed(journal['operations'])])
+    journal['status'] = 'rolled_back'
+    journal['directories'] = {}
+    write_journal(journal_path, journal)
+    print("{}: rolled back {} files".format(task, moved))
+    return moved
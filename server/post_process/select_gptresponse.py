@@ -1,36 +1,27 @@
-import os
-import shutil
+import argparse
+from gpt_archive import default_archive_path, open_archive, update_archive, link_final_responses, pack_final_responses, report_partial_sessions
 
 # Define the directory paths
 source_directory = '/srv/chat-room/server/private/gptResponses'
 destination_directory = '/srv/chat-room/server/private/gptResponsesFinal'
 
-# Create the destination directory if it doesn't exist
-if not os.path.exists(destination_directory):
-    os.makedirs(destination_directory)
+def select_gptresponses(directory=source_directory, destination=destination_directory, archive_file=None):
+    # The response files stay where the server wrote them; the final response of
+    # each session (v3, which holds all responses) is hard linked into the destination
+    conn = open_archive(default_archive_path)
+    summary = update_archive(conn, [directory])
+    print("Indexed GPT responses:", summary)
+    print("Linked {} final responses into {}".format(link_final_responses(conn, destination), destination))
+    if archive_file:
+        print("Packed {} final responses into {}".format(pack_final_responses(conn, archive_file), archive_file))
+    # Sessions that ended before their v3 response have no full response
+    report_partial_sessions(conn)
 
-# Function to rename files
-def rename_file(file_path, new_name):
-    directory, old_name = os.path.split(file_path)
-    new_path = os.path.join(directory, new_name)
-    os.rename(file_path, new_path)
-    return new_path
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect the final GPT response of every session.")
+    parser.add_argument('--source', default=source_directory)
+    parser.add_argument('--destination', default=destination_directory)
+    parser.add_argument('--archive', help="also pack the final responses into this zip file")
+    args = parser.parse_args()
 
-# Iterate through all files in the source directory
-for root, dirs, files in os.walk(source_directory):
-    for file_name in files:
-        if file_name.endswith('.json'):
-            # Replace colons in the timestamp with dots
-            new_name = file_name.replace(':', '.')
-
-            # Full path to the original and new files
-            old_file_path = os.path.join(root, file_name)
-            new_file_path = rename_file(old_file_path, new_name)
-
-            # If the file is a v3 file, rename "v3" to "full" and move it
-            if 'v3' in new_name:
-                final_name = new_name.replace('v3', 'full')
-                final_file_path = rename_file(new_file_path, final_name)
-                
-                # Move the file to the final directory
-                shutil.move(final_file_path, destination_directory)
+    select_gptresponses(args.source, args.destination, args.archive)
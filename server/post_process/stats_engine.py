@@ -0,0 +1,211 @@
+import os
+import csv
+import json
+import argparse
+import numpy as np
+from log_catalog import default_catalog_path, open_catalog, update_catalog
+from export_columnar import build_tables, load_tables
+from async_io import add_arguments as add_io_arguments
+
+# Study-wide statistics computed with array operations over the tables of
+# export_columnar. A session is one run of a room (spec + startTime) and is
+# described by its log of the selected version; when the same session was
+# logged into several directories the first copy is used.
+
+
+def load_spec_bot_types(spec_directory, specs):
+    bot_types = {}
+    for spec in specs:
+        spec_path = os.path.join(spec_directory, spec + '.json')
+        if os.path.exists(spec_path):
+            with open(spec_path, 'r') as f:
+                bot_types[spec] = json.load(f).get('botType') or ''
+    return bot_types
+
+
+def select_sessions(rooms, version):
+    # Returns the rooms rows used as sessions and a log_index -> session lookup (-1 for unused logs)
+    chosen = np.flatnonzero(rooms['log_version'] == version)
+    keys = np.char.add(np.char.add(rooms['spec'][chosen].astype(str), '|'), rooms['session_start'][chosen].astype(str))
+    _, first = np.unique(keys, return_index=True)
+    chosen = chosen[np.sort(first)]
+    session_of_log = np.full(len(rooms['log_index']), -1, dtype=np.int64)
+    session_of_log[rooms['log_index'][chosen]] = np.arange(len(chosen))
+    return chosen, session_of_log
+
+
+def lookup_counts(values, counts, keys):
+    # counts[i] for each key equal to values[i], 0 where the key is absent
+    if len(values) == 0:
+        return np.zeros(len(keys), dtype=np.int64)
+    positions = np.minimum(np.searchsorted(values, keys), len(values) - 1)
+    return np.where(values[positions] == keys, counts[positions], 0)
+
+
+def compute_statistics(tables, version=4, spec_bot_types=None):
+    rooms, comments, users = tables['rooms'], tables['comments'], tables['users']
+    chosen, session_of_log = select_sessions(rooms, version)
+    num_sessions = len(chosen)
+
+    bot_types = rooms['bot_type'][chosen].astype(str)
+    if spec_bot_types:
+        specs = rooms['spec'][chosen].astype(str)
+        bot_types = np.array([spec_bot_types.get(spec, bot_type) for spec, bot_type in zip(specs, bot_types)],
+                             dtype=str)
+
+    comment_session = session_of_log[comments['log_index']]
+    in_session = comment_session >= 0
+    comment_session = comment_session[in_session]
+    comment_bot = comments['bot'][in_session].astype(bool)
+    comment_depth = comments['depth'][in_session]
+    comment_offset = comments['time_offset'][in_session]
+    comment_names = comments['user_name'][in_session].astype(str)
+
+    user_session = session_of_log[users['log_index']]
+    in_session = user_session >= 0
+    user_session = user_session[in_session]
+    user_names = users['name'][in_session].astype(str)
+    user_pids = users['prolific_pid'][in_session].astype(str)
+
+    # Comment counts per session
+    total = np.bincount(comment_session, minlength=num_sessions)
+    top_level = np.bincount(comment_session, weights=comment_depth == 0, minlength=num_sessions).astype(np.int64)
+    bot_comments = np.bincount(comment_session, weights=comment_bot, minlength=num_sessions).astype(np.int64)
+    human_comments = total - bot_comments
+    bot_ratio = np.divide(bot_comments, total, out=np.zeros(num_sessions), where=total > 0)
+    max_depth = np.zeros(num_sessions, dtype=np.int64)
+    np.maximum.at(max_depth, comment_session, comment_depth)
+
+    first_comment = np.full(num_sessions, np.inf)
+    timed = ~comment_bot & ~np.isnan(comment_offset)
+    np.minimum.at(first_comment, comment_session[timed], comment_offset[timed])
+    first_comment[np.isinf(first_comment)] = np.nan
+
+    # Users are keyed by (session, name); a name listed twice in one log counts once
+    _, name_codes = np.unique(np.concatenate([user_names, comment_names]), return_inverse=True)
+    num_names = int(name_codes.max()) + 1 if len(name_codes) else 1
+    all_user_keys = user_session * num_names + name_codes[:len(user_names)]
+    comment_keys = comment_session * num_names + name_codes[len(user_names):]
+    _, first_rows = np.unique(all_user_keys, return_index=True)
+    user_rows = np.sort(first_rows)
+    user_keys = all_user_keys[user_rows]
+
+    key_values, key_counts = np.unique(comment_keys, return_counts=True)
+    user_comments = lookup_counts(key_values, key_counts, user_keys)
+    key_values, key_counts = np.unique(comment_keys[comment_depth == 0], return_counts=True)
+    user_top_level = lookup_counts(key_values, key_counts, user_keys)
+
+    # As in log_statistics, a user speaks with at least one top-level comment
+    speaks = user_top_level > 0
+    num_users = np.bincount(user_session[user_rows], minlength=num_sessions)
+    num_users_speak = np.bincount(user_session[user_rows][speaks], minlength=num_sessions)
+
+    # Comments per minute since the session started
+    timed = ~np.isnan(comment_offset) & (comment_offset >= 0)
+    minutes = (comment_offset[timed] // 60).astype(np.int64)
+    num_minutes = int(minutes.max()) + 1 if len(minutes) else 0
+    activity = np.bincount(comment_session[timed] * num_minutes + minutes,
+                           minlength=num_sessions * num_minutes).reshape(num_sessions, num_minutes)
+
+    sessions = {
+        'room_id': rooms['room_id'][chosen],
+        'spec': rooms['spec'][chosen].astype(str),
+        'session_start': rooms['session_start'][chosen].astype(str),
+        'bot_type': bot_types,
+        'num_users': num_users,
+        'num_users_speak': num_users_speak,
+        'num_comments': top_level,
+        'num_replies': total - top_level,
+        'bot_comments': bot_comments,
+        'human_comments': human_comments,
+        'bot_ratio': bot_ratio,
+        'max_reply_depth': max_depth,
+        'time_to_first_comment': first_comment,
+        'file': np.array([os.path.basename(path) for path in rooms['path'][chosen].astype(str)], dtype=str),
+    }
+    user_stats = {
+        'spec': sessions['spec'][user_session[user_rows]],
+        'session_start': sessions['session_start'][user_session[user_rows]],
+        'name': user_names[user_rows],
+        'prolific_pid': user_pids[user_rows],
+        'comments': user_comments,
+        'top_level_comments': user_top_level,
+        'replies': user_comments - user_top_level,
+        'speaks': speaks,
+    }
+    return sessions, user_stats, activity
+
+
+def summarize(sessions, version):
+    summary = {
+        'log_version': version,
+        'sessions': len(sessions['spec']),
+        'comments': int(sessions['num_comments'].sum()),
+        'replies': int(sessions['num_replies'].sum()),
+        'bot_comments': int(sessions['bot_comments'].sum()),
+        'human_comments': int(sessions['human_comments'].sum()),
+        'by_bot_type': {},
+    }
+    labels, groups = np.unique(sessions['bot_type'], return_inverse=True)
+    for code, label in enumerate(labels):
+        members = groups == code
+        speaking, rooms = np.unique(sessions['num_users_speak'][members], return_counts=True)
+        summary['by_bot_type'][label or 'null'] = {
+            'sessions': int(members.sum()),
+            'mean_users_speaking': float(sessions['num_users_speak'][members].mean()),
+            'mean_comments': float(sessions['num_comments'][members].mean()),
+            'mean_bot_ratio': float(sessions['bot_ratio'][members].mean()),
+            'rooms_by_users_speaking': dict((str(count), int(number)) for count, number in zip(speaking, rooms)),
+        }
+    return summary
+
+
+def write_columns_csv(columns, output_csv):
+    names = list(columns)
+    with open(output_csv, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(names)
+        writer.writerows(zip(*(columns[name].tolist() for name in names)))
+
+
+def write_statistics(sessions, user_stats, activity, version, output_dir):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    write_columns_csv(sessions, os.path.join(output_dir, 'session_stats.csv'))
+    write_columns_csv(user_stats, os.path.join(output_dir, 'user_stats.csv'))
+
+    with open(os.path.join(output_dir, 'activity_per_minute.csv'), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['spec', 'session_start'] + ['minute_{}'.format(minute) for minute in range(activity.shape[1])])
+        for spec, session_start, counts in zip(sessions['spec'], sessions['session_start'], activity.tolist()):
+            writer.writerow([spec, session_start] + counts)
+
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summarize(sessions, version), f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute study statistics from columnar chat log tables.")
+    parser.add_argument('directories', nargs='*', help="chatlog directories to read through the catalog")
+    parser.add_argument('--columnar', help="directory written by export_columnar.py, instead of directories")
+    parser.add_argument('--version', type=int, default=4, help="log version describing a session")
+    parser.add_argument('--room-specs', help="roomSpecs directory; its botType overrides the logged one")
+    parser.add_argument('--output', default='/srv/chat-room/server/private/chatLogs/statistics/')
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes for reading logs")
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    if args.columnar:
+        tables = load_tables(args.columnar)
+    else:
+        catalog = open_catalog(default_catalog_path)
+        update_catalog(catalog, args.directories, args.jobs, args.io_concurrency)
+        tables = build_tables(catalog, args.directories, [args.version], args.jobs, args.io_concurrency)
+
+    spec_bot_types = None
+    if args.room_specs:
+        spec_bot_types = load_spec_bot_types(args.room_specs, np.unique(tables['rooms']['spec'].astype(str)))
+
+    sessions, user_stats, activity = compute_statistics(tables, args.version, spec_bot_types)
+    write_statistics(sessions, user_stats, activity, args.version, args.output)
+    print("Wrote statistics for {} sessions to {}".format(len(sessions['spec']), args.output))
@@ -0,0 +1,206 @@
+import os
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Generates chat log trees shaped like the ones Logs.writeLog produces, for
+# testing and benchmarking the post-processing scripts without study data.
+# A session writes log 1 (0-2 min), 2 (2-5), 3 (5-8), a log 4 at the end of
+# the room (0-10) and a second log 4 one minute later (0-11). By default the
+# files get the names they have after rename_log and correct_log_5; with raw
+# they keep the names the server writes.
+
+bot_types = ['', 'Alex (Moderator)', 'Alex']
+
+# (version written, first minute, last minute, minute written)
+log_schedule = [(1, 0, 2, 2), (2, 2, 5, 5), (3, 5, 8, 8), (4, 0, 10, 10), (4, 0, 11, 11)]
+
+words = ['AI', 'health', 'doctors', 'data', 'privacy', 'diagnosis', 'patients', 'trust', 'costs', 'errors',
+         'I', 'think', 'agree', 'but', 'maybe', 'should', 'could', 'never', 'always', 'because', 'the', 'is']
+
+
+def format_time(time):
+    # JSON.stringify of a Date
+    return time.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(time.microsecond // 1000)
+
+
+def format_filename(spec, time, version, raw):
+    # moment(...).format("D.MM.YYYY-HH:mm"); rename_log turns ':' into '.'
+    stamp = '{}.{:02d}.{}-{:02d}:{:02d}'.format(time.day, time.month, time.year, time.hour, time.minute)
+    if raw:
+        return '{}_{}_{}.log.json'.format(spec, stamp, version)
+    return '{}_{}_{}_log.json'.format(spec, stamp.replace(':', '.'), version)
+
+
+class SessionGenerator(object):
+    def __init__(self, seed=0, users_per_room=5, comment_rate=0.5, reply_probability=0.3, reply_depth=1,
+                 words_per_comment=20):
+        self.random = random.Random(seed)
+        self.users_per_room = users_per_room
+        # Comments per user and minute
+        self.comment_rate = comment_rate
+        self.reply_probability = reply_probability
+        # The server nests replies one level deep; bot comments from room specs can nest further
+        self.reply_depth = reply_depth
+        self.words_per_comment = words_per_comment
+        # Comment ids are counted across the whole server run, like in Chats
+        self.comment_id = 1
+
+    def content(self):
+        length = max(1, int(self.random.expovariate(1.0 / self.words_per_comment)))
+        return ' '.join(self.random.choice(words) for _ in range(length))
+
+    def comment(self, time, user_name, bot=False):
+        comment = {
+            'id': self.comment_id,
+            'bot': bot,
+            'time': time,
+            'userName': user_name,
+            'content': self.content(),
+        }
+        self.comment_id += 1
+        return comment
+
+    def add_replies(self, comment, users, depth, end):
+        replies = []
+        while depth <= self.reply_depth and self.random.random() < self.reply_probability:
+            time = comment['time'] + timedelta(seconds=self.random.uniform(5, 90))
+            if time >= end:
+                break
+            reply = self.comment(time, self.random.choice(users)['name'])
+            self.add_replies(reply, users, depth + 1, end)
+            replies.append(reply)
+        if replies:
+            comment['replies'] = sorted(replies, key=lambda reply: reply['time'])
+
+    def session(self, spec, room_id, start, duration=10):
+        bot_type = bot_types[room_id % len(bot_types)]
+        users = []
+        for i in range(self.users_per_room):
+            users.append({
+                'id': '{}_{}'.format(spec, i),
+                'name': 'User{}_{}'.format(room_id, i),
+                'prolificPid': '{:024x}'.format(self.random.getrandbits(96)),
+                'sessionId': '{:024x}'.format(self.random.getrandbits(96)),
+                'studyId': 'study',
+            })
+
+        end = start + timedelta(minutes=duration + 1)
+        comments = []
+        count = int(self.random.gauss(self.comment_rate * len(users) * duration, 2))
+        for _ in range(max(0, count)):
+            time = start + timedelta(seconds=self.random.uniform(0, duration * 60 + 59))
+            comment = self.comment(time, self.random.choice(users)['name'])
+            self.add_replies(comment, users, 1, end)
+            comments.append(comment)
+
+        # GPT suggestions are posted at 02:03, 05:03 and 08:03 in moderated rooms
+        if bot_type:
+            for minute in (2, 5, 8):
+                comments.append(self.comment(start + timedelta(minutes=minute, seconds=3), bot_type, True))
+        comments.sort(key=lambda comment: comment['time'])
+
+        return {
+            'id': '{:x}'.format(self.random.getrandbits(128)),
+            'specFileName': spec + '.json',
+            'name': 'The Online Discussion Room',
+            'startTime': start,
+            'duration': duration,
+            'postTitle': 'Artificial Intelligence in Healthcare - What Do You Think?',
+            'users': users,
+            'comments': comments,
+            'botType': bot_type,
+            'outboundLink': 'https://ipz.qualtrics.com/jfe/form/SV_aXIdNomI88sWYDk',
+        }
+
+
+def serialize(value):
+    if isinstance(value, datetime):
+        return format_time(value)
+    if isinstance(value, list):
+        return [serialize(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, serialize(item)) for key, item in value.items())
+    return value
+
+
+def written_comment(comment, written):
+    # Replies are attached when the log is written, so later replies are missing
+    logged = dict((key, value) for key, value in comment.items() if key != 'replies')
+    replies = [written_comment(reply, written) for reply in comment.get('replies') or [] if reply['time'] < written]
+    if replies:
+        logged['replies'] = replies
+    return logged
+
+
+def session_logs(session):
+    # Yields (version, number of log 4 so far, time written, log) like assembleLog for every log of the session
+    start = session['startTime']
+    fours = 0
+    for version, first, last, written_minute in log_schedule:
+        written = start + timedelta(minutes=written_minute, seconds=1)
+        comments = []
+        for comment in session['comments']:
+            minute = int((comment['time'] - start).total_seconds() // 60)
+            if first <= minute < last and comment['time'] < written:
+                comments.append(written_comment(comment, written))
+        log = dict(session)
+        log['comments'] = comments
+        if version == 4:
+            fours += 1
+        yield version, fours, written, log
+
+
+def write_session(session, directory, raw=False):
+    paths = []
+    spec = session['specFileName'].split('.')[0]
+    for version, fours, written, log in session_logs(session):
+        # correct_log_5 names the later log 4 log 5
+        name_version = 5 if version == 4 and fours == 2 and not raw else version
+        path = os.path.join(directory, format_filename(spec, written, name_version, raw))
+        with open(path, 'w') as f:
+            json.dump(serialize(log), f, indent=2, ensure_ascii=False)
+        paths.append(path)
+    return paths
+
+
+def generate_tree(output_dir, rooms, rooms_per_directory=100, concurrent_rooms=50, start=None, raw=False,
+                  seed=0, **options):
+    # Rooms run in waves of concurrent_rooms, one wave every 15 minutes. Returns the chatlog directories
+    start = start or datetime(2024, 7, 18, 9, 0)
+    generator = SessionGenerator(seed, **options)
+    directories = []
+    for room in range(rooms):
+        if room % rooms_per_directory == 0:
+            directory = os.path.join(output_dir, 'chatlog_{:04d}'.format(room // rooms_per_directory))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            directories.append(directory)
+        room_id = room % rooms_per_directory + 1
+        session_start = start + timedelta(minutes=15 * (room // concurrent_rooms),
+                                          seconds=generator.random.uniform(0, 30))
+        session = generator.session('pilot_study_{}'.format(room_id), room_id, session_start)
+        write_session(session, directories[-1], raw)
+    return directories
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic chat log directories.")
+    parser.add_argument('output', help="directory to write the chatlog directories to")
+    parser.add_argument('--rooms', type=int, default=100, help="number of room sessions")
+    parser.add_argument('--rooms-per-directory', type=int, default=100)
+    parser.add_argument('--concurrent-rooms', type=int, default=50, help="rooms running at the same time")
+    parser.add_argument('--users-per-room', type=int, default=5)
+    parser.add_argument('--comment-rate', type=float, default=0.5, help="comments per user and minute")
+    parser.add_argument('--reply-probability', type=float, default=0.3)
+    parser.add_argument('--reply-depth', type=int, default=1, help="deepest level of nested replies")
+    parser.add_argument('--raw', action='store_true', help="use the file names the server writes")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directories = generate_tree(args.output, args.rooms, args.rooms_per_directory, args.concurrent_rooms,
+                                raw=args.raw, seed=args.seed, users_per_room=args.users_per_room,
+                                comment_rate=args.comment_rate, reply_probability=args.reply_probability,
+                                reply_depth=args.reply_depth)
+    print("Generated {} rooms in {} directories under {}".format(args.rooms, len(directories), args.output))
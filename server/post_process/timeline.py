@@ -0,0 +1,145 @@
+import json
+import bisect
+import argparse
+from datetime import datetime, timedelta
+from log_catalog import default_catalog_path, open_catalog, update_catalog, iter_logs, log_comment_hashes, log_offsets
+from log_dedup import reconstruct_union
+from log_reader import parse_log_time
+from async_io import add_arguments as add_io_arguments
+
+# Rebuilds each room session from all the logs written for it. The server
+# writes windowed snapshots (version 1: minutes 0-2, 2: 2-5, 3: 5-8) and two
+# logs numbered 4: one for minutes 0-10 when the room ends, and one for minutes
+# 0-11 a minute later. correct_log_5 renames the later one, so version 4 covers
+# minutes 0-10 and version 5 minutes 0-11. Every snapshot may miss comments or
+# replies another one holds, so the logs of a session are merged by comment id
+# (see log_dedup): each comment and each reply appears once, in time order.
+# Only the log with the most comments is read in full; from the others only
+# the comments the catalog shows to be missing are decoded.
+#
+# A Timeline answers time-range queries by bisection over its comment times.
+
+timeline_fields = ('users', 'comments')
+
+
+def time_key(value):
+    # Log times are ISO strings of one format (Date.toISOString), so they sort as text
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(value.microsecond // 1000)
+    return value
+
+
+class Timeline(object):
+    def __init__(self, log, sources=()):
+        self.fields = dict((key, value) for key, value in log.items() if key not in timeline_fields)
+        self.users = log.get('users') or []
+        self.comments = log.get('comments') or []
+        self.sources = list(sources)
+        self.times = [comment.get('time') or '' for comment in self.comments]
+
+        # Every message, replies included, as (time, id of the comment replied to, comment)
+        events = []
+
+        def add(comment, parent_id):
+            events.append((comment.get('time') or '', parent_id, comment))
+            for reply in comment.get('replies') or []:
+                add(reply, comment.get('id'))
+
+        for comment in self.comments:
+            add(comment, None)
+        # Stable sort, so messages sharing a timestamp keep their logged order
+        events.sort(key=lambda event: event[0])
+        self.events = events
+        self.event_times = [event[0] for event in events]
+
+    def start(self):
+        # None if the log has no readable startTime
+        return parse_log_time(self.fields.get('startTime'))
+
+    def span(self, times, start, end):
+        # Positions of the times in [start, end); either bound may be None
+        low = bisect.bisect_left(times, time_key(start)) if start is not None else 0
+        high = bisect.bisect_left(times, time_key(end)) if end is not None else len(times)
+        return low, max(low, high)
+
+    def comments_between(self, start=None, end=None):
+        # Top-level comments posted in [start, end), with all their replies
+        low, high = self.span(self.times, start, end)
+        return self.comments[low:high]
+
+    def events_between(self, start=None, end=None):
+        # Comments and replies posted in [start, end)
+        low, high = self.span(self.event_times, start, end)
+        return self.events[low:high]
+
+    def window(self, start_minute, end_minute):
+        # Top-level comments of minutes [start_minute, end_minute) of the session, as the
+        # server selects them for a log version (e.g. window(2, 5) for version 2)
+        start = self.start()
+        return self.comments_between(start + timedelta(minutes=start_minute), start + timedelta(minutes=end_minute))
+
+    def as_dict(self):
+        log = dict(self.fields)
+        log['users'] = self.users
+        log['comments'] = self.comments
+        return log
+
+
+def session_logs(conn, directories, kinds=('log',), recursive=False):
+    # {(spec, session_start): [catalog rows]}, newest version first; logs the catalog
+    # could not read have no session_start and are left out
+    sessions = {}
+    for row in iter_logs(conn, directories, kinds=kinds, recursive=recursive):
+        if row['session_start'] is None or row['comments_digest'] is None:
+            continue
+        sessions.setdefault((row['spec'], row['session_start']), []).append(row)
+    for rows in sessions.values():
+        rows.sort(key=lambda row: -row['version'])
+    return sessions
+
+
+def build_timeline(conn, rows):
+    # Timeline of one session from the catalog rows of its logs
+    paths = [row['path'] for row in rows]
+    hashes = log_comment_hashes(conn, paths)
+    offsets = dict((path, log_offsets(conn, path)) for path in paths)
+    return Timeline(reconstruct_union(paths, hashes, offsets), paths)
+
+
+def iter_timelines(conn, directories, kinds=('log',), recursive=False):
+    sessions = session_logs(conn, directories, kinds, recursive)
+    for key in sorted(sessions):
+        yield key, build_timeline(conn, sessions[key])
+
+
+def write_timelines(timelines, output_jsonl):
+    # One session per line: its full log and the logs it was rebuilt from
+    count = 0
+    with open(output_jsonl, 'w') as f:
+        for _, timeline in timelines:
+            record = {'sources': timeline.sources, 'log': timeline.as_dict()}
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+            count += 1
+    return count
+
+
+def read_timelines(output_jsonl):
+    with open(output_jsonl, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            yield Timeline(record['log'], record['sources'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild every room session from all of its log versions.")
+    parser.add_argument('directories', nargs='+', help="chatlog directories")
+    parser.add_argument('--output', default='/srv/chat-room/chat-room.git/timelines.jsonl')
+    parser.add_argument('--recursive', action='store_true', help="include the subdirectories of the directories")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes for parsing new logs")
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    update_catalog(catalog, args.directories, args.jobs, args.io_concurrency)
+    count = write_timelines(iter_timelines(catalog, args.directories, recursive=args.recursive), args.output)
+    print("Wrote {} sessions to {}".format(count, args.output))
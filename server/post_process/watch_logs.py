@@ -0,0 +1,234 @@
+import os
+import csv
+import json
+import time
+import argparse
+import traceback
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from log_catalog import default_catalog_path, open_catalog, update_catalog
+from log_names import parse_log_filename
+from log_pairing import default_min_delta, default_max_delta
+from merge_log import collect_directory_logs, run_room_task, merge_room_metrics, write_room_full_logs, make_sure_path_exists
+from log_statistics import find_unique_users, count_users_in_logs
+from participant_index import update_participants
+from rename_log import correct_and_rename_logs
+from correct_log_5 import resolve_double_four_log_issue
+from instrumentation import add_arguments, instrumented
+from async_io import add_arguments as add_io_arguments
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Long-running post-processing of the chatLogs directory. Logs.writeLog drops
+# <spec>_<D.MM.YYYY-HH:mm>_<version>.log.json files at 2, 5, 8 and 11 minutes;
+# they are collected until the directory has been quiet for a while and then
+# run through the pipeline as one batch:
+#   rename_log -> correct_log_5 -> catalog -> pair and merge -> statistics
+# Only the rooms of the batch are paired and merged again. inotify is used when
+# the inotify_simple package is installed, polling otherwise.
+
+
+def is_new_log(filename):
+    # Only files written by the server start a batch; the renames done by the
+    # pipeline itself are ignored
+    name_info = parse_log_filename(filename)
+    return name_info is not None and name_info.kind == 'raw'
+
+
+class PollingWatcher(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and is_new_log(entry.name):
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        snapshot = self.scan()
+        changed = [name for name, info in snapshot.items() if self.snapshot.get(name) != info]
+        self.snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(object):
+    def __init__(self, directory):
+        self.inotify = inotify_simple.INotify()
+        # writeFile closes the log once it is complete
+        self.inotify.add_watch(directory, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+
+    def changes(self, timeout):
+        return [event.name for event in self.inotify.read(timeout=int(timeout * 1000)) if is_new_log(event.name)]
+
+
+class Pipeline(object):
+    def __init__(self, directory, output_dir, catalog, jobs=1, min_delta=default_min_delta,
+                 max_delta=default_max_delta, io_concurrency=0):
+        self.directory = directory
+        self.output_dir = output_dir
+        self.full_log_dir = os.path.join(output_dir, 'full_logs')
+        self.catalog = catalog
+        self.jobs = jobs
+        self.min_delta = min_delta
+        self.max_delta = max_delta
+        self.io_concurrency = io_concurrency
+        # Results per room, replaced whenever a room is merged again
+        self.room_results = {}
+        make_sure_path_exists(self.full_log_dir)
+
+    def run(self, filenames=None):
+        # filenames of the batch; None processes every room of the directory
+        started = time.time()
+        correct_and_rename_logs(self.directory)
+        # Only the sessions of the batch are paired, so earlier ones are never renamed again
+        resolve_double_four_log_issue(self.directory, filenames=filenames)
+        summary = update_catalog(self.catalog, [self.directory], self.jobs, self.io_concurrency)
+        update_participants(self.catalog)
+
+        rooms = None
+        if filenames is not None:
+            rooms = set((name_info.spec, name_info.room_id) for name_info in map(parse_log_filename, filenames))
+        merged = self.merge(rooms)
+        self.write_results()
+
+        find_unique_users([self.directory], os.path.join(self.output_dir, 'duplicate_usernames.txt'), self.catalog)
+        count_users_in_logs([self.directory], os.path.join(self.output_dir, 'log_statistics.csv'),
+                            os.path.join(self.output_dir, 'speaking_stats.txt'), self.catalog)
+        print("Processed {} new logs, merged {} rooms in {:.1f}s (catalog: {})".format(
+            len(filenames) if filenames is not None else summary['added'], merged, time.time() - started, summary))
+
+    def merge(self, rooms):
+        log4_files, log5_files, log_info = collect_directory_logs(self.catalog, self.directory)
+        # As in merge_log.process_directories, full logs are written afterwards, many at a time
+        deferred = self.io_concurrency > 1 and self.jobs <= 1
+        tasks = []
+        room_keys = []
+        for room_key in log4_files:
+            if rooms is not None and room_key not in rooms:
+                continue
+            room_entries = log4_files[room_key] + log5_files.get(room_key, [])
+            room_info = {path: log_info[path] for _, path in room_entries}
+            room_keys.append(room_key)
+            tasks.append((room_key[1], log4_files[room_key], log5_files.get(room_key, []), room_info,
+                          self.full_log_dir, self.min_delta, self.max_delta, False, not deferred))
+
+        if self.jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(run_room_task, tasks))
+        else:
+            results = [run_room_task(task) for task in tasks]
+        merge_room_metrics(results)
+        if deferred:
+            write_room_full_logs(results, self.io_concurrency)
+
+        for room_key, result in zip(room_keys, results):
+            self.room_results[room_key] = result
+        # A log5 whose log4 is gone leaves nothing to merge
+        for room_key in list(self.room_results):
+            if room_key not in log4_files:
+                del self.room_results[room_key]
+        return len(tasks)
+
+    def write_results(self):
+        room_keys = sorted(self.room_results, key=lambda room_key: (room_key[1] is None, room_key[1] or 0, room_key[0]))
+        with open(os.path.join(self.output_dir, 'comparison.csv'), 'w', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(['Room ID', 'Timestamp', 'Log4 Filename', 'Log5 Filename', 'Different?', 'Selected Log'])
+            for room_key in room_keys:
+                csvwriter.writerows(self.room_results[room_key]['comparison_rows'])
+
+        # Sessions still waiting for their log5 show up as unmatched log4 files
+        report = {'directory': self.directory, 'unmatched_log4': [], 'unmatched_log5': [], 'ambiguous': []}
+        for room_key in room_keys:
+            result = self.room_results[room_key]
+            report['unmatched_log4'].extend(result['unmatched_log4'])
+            report['unmatched_log5'].extend(result['unmatched_log5'])
+            report['ambiguous'].extend({'log4': log4_path, 'log5_candidates': candidates}
+                                       for log4_path, candidates in result['ambiguous'])
+        with open(os.path.join(self.output_dir, 'pairing_report.json'), 'w') as f:
+            json.dump([report], f, indent=2)
+
+
+def run_batch(pipeline, filenames):
+    # A failing batch (a rename collision, a log not fully written yet) is reported and
+    # retried later rather than stopping the watcher; returns whether it completed
+    try:
+        pipeline.run(sorted(filenames))
+        return True
+    except Exception:
+        traceback.print_exc()
+        # Nothing of the failed batch is left half-stored in the catalog
+        pipeline.catalog.rollback()
+        print("Batch of {} new logs failed, retrying after the next quiet period".format(len(filenames)))
+        return False
+
+
+def watch(watcher, pipeline, quiet_period, max_delay, poll_interval):
+    # Debounce: a batch runs once no new log arrived for quiet_period seconds, or
+    # max_delay seconds after its first log while logs keep arriving
+    pending = set()
+    first_change = last_change = None
+    try:
+        while True:
+            filenames = watcher.changes(poll_interval)
+            now = time.monotonic()
+            if filenames:
+                pending.update(filenames)
+                last_change = now
+                if first_change is None:
+                    first_change = now
+            if pending and (now - last_change >= quiet_period or now - first_change >= max_delay):
+                if run_batch(pipeline, pending):
+                    pending = set()
+                    first_change = last_change = None
+                else:
+                    # The failed logs stay pending and wait for another quiet period
+                    first_change = last_change = now
+    except KeyboardInterrupt:
+        if pending:
+            run_batch(pipeline, pending)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the chat log directory and post-process new logs.")
+    parser.add_argument('--directory', default='/srv/chat-room/server/private/chatLogs')
+    parser.add_argument('--output', default='/srv/chat-room/server/private/processedLogs')
+    parser.add_argument('--quiet-period', type=float, default=60, help="seconds without new logs before a batch runs")
+    parser.add_argument('--max-delay', type=float, default=300, help="longest a new log waits while logs keep arriving")
+    parser.add_argument('--poll-interval', type=float, default=5, help="seconds between checks of the directory")
+    parser.add_argument('--polling', action='store_true', help="poll the directory even if inotify is available")
+    parser.add_argument('--once', action='store_true', help="process the directory once and exit")
+    parser.add_argument('--jobs', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--min-delta', type=int, default=1, help="minimum minutes between a log4 and its log5")
+    parser.add_argument('--max-delta', type=int, default=2, help="maximum minutes between a log4 and its log5")
+    add_arguments(parser)
+    add_io_arguments(parser)
+    args = parser.parse_args()
+
+    catalog = open_catalog(default_catalog_path)
+    pipeline = Pipeline(args.directory, args.output, catalog, args.jobs,
+                        timedelta(minutes=args.min_delta), timedelta(minutes=args.max_delta), args.io_concurrency)
+
+    # Start the watch before the first pass, so logs landing during it are not missed
+    if not args.once:
+        if inotify_simple is not None and not args.polling:
+            watcher = InotifyWatcher(args.directory)
+        else:
+            watcher = PollingWatcher(args.directory)
+
+    # Metrics cover every batch until the watcher stops
+    with instrumented(args, 'watch_logs'):
+        # Catch up on everything written while the watcher was not running
+        pipeline.run()
+        if not args.once:
+            print("Watching {} for new logs".format(args.directory))
+            watch(watcher, pipeline, args.quiet_period, args.max_delay, args.poll_interval)
@@ -1,46 +1,135 @@
-import json
 import os
+import json
+import base64
+import hashlib
+import argparse
+from urllib.parse import quote
 
 # Directory where the room files are stored
 directory = "/srv/chat-room/server/private/chatPrograms/roomSpecs/"
 
-# Number of rooms to create
-total_rooms = 87
-
-# Parameters for the room files
-room_base = {
-    "roomName": "the online discussion room",
-    "startTime": "",
-    "postName": "prompt_test_chat.json",
-    "duration": 10,
-    "outboundLink": "https://ipz.qualtrics.com/jfe/form/SV_aXIdNomI88sWYDk",
-    "comments": []
-}
-
-# Function to determine the botType based on the room id
-def get_bot_type(room_id):
-    if room_id % 3 == 1:
-        return "Alex (Moderator)"
-    elif room_id % 3 == 2:
-        return "Alex"
-    else:
-        return ""
-
-# Function to create room files
-def create_room_files(directory, total_rooms, room_base):
+# Index of all room files with their access hashes; the server reads it instead
+# of listing and hashing the room directory
+manifest_path = "/srv/chat-room/server/private/chatPrograms/roomManifest.json"
+manifest_version = 1
+
+# Study design to create rooms from (see README, "Batch Creating Multiple Chatrooms")
+design_path = "/srv/chat-room/server/private/chatPrograms/studies/pilot_study.json"
+
+# The design's rooms are <name>_<id>.json for ids firstId .. firstId + rooms - 1.
+# Each room gets the "base" fields plus one level of every factor; rooms are
+# assigned to the combinations of levels in proportion to the product of their
+# ratios, interleaved so that any first n rooms are as balanced as possible.
+# The assignment only depends on the design, so room ids are stable, and adding
+# rooms to a design leaves the existing ones unchanged.
+
+# Function to compute the access hash of a room, as fileNameToHash in server/util/room.ts
+def room_hash(file_name):
+    digest = base64.b64encode(hashlib.sha256(file_name.encode("utf-8")).digest()).decode("ascii")
+    # encodeURIComponent keeps letters, digits and -_.!~*'()
+    return quote(digest, safe="-_.!~*'()")
+
+# Function to read a study design and check its ratios
+def load_design(path):
+    with open(path, "r") as f:
+        design = json.load(f)
+    for name, factor in design.get("factors", {}).items():
+        ratios = factor.get("ratios", [1] * len(factor["levels"]))
+        if len(ratios) != len(factor["levels"]) or any(ratio < 0 for ratio in ratios) or not any(ratios):
+            raise ValueError("Factor {} needs one non-negative ratio per level".format(name))
+    return design
+
+# Function to list the combinations of factor levels with their weights
+def design_cells(design):
+    cells = [({}, 1)]
+    for name, factor in design.get("factors", {}).items():
+        ratios = factor.get("ratios", [1] * len(factor["levels"]))
+        cells = [(dict(values, **{name: level}), weight * ratio)
+                 for values, weight in cells
+                 for level, ratio in zip(factor["levels"], ratios) if ratio]
+    return cells
+
+# Function to assign a combination to each room (smooth weighted round robin)
+def assign_cells(cells, total_rooms):
+    total = sum(weight for _, weight in cells)
+    current = [0] * len(cells)
+    for _ in range(total_rooms):
+        for i, (_, weight) in enumerate(cells):
+            current[i] += weight
+        chosen = max(range(len(cells)), key=lambda i: current[i])
+        current[chosen] -= total
+        yield cells[chosen][0]
+
+# Function to generate the room specs of a design as (file name, room data)
+def design_rooms(design):
+    first_id = design.get("firstId", 1)
+    for index, values in enumerate(assign_cells(design_cells(design), design["rooms"])):
+        room_data = dict(design.get("base", {}))
+        room_data.update(values)
+        yield "{}_{}.json".format(design["name"], first_id + index), room_data
+
+# Function to read an existing room file, if it can be read
+def read_room(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Function to create room files; files already holding the same room are left alone
+def create_room_files(directory, rooms):
     if not os.path.exists(directory):
         os.makedirs(directory)
-        
-    for room_id in range(1, total_rooms + 1):
-        room_data = room_base.copy()
-        room_data["botType"] = get_bot_type(room_id)
-        # Specify the room file name
-        room_file_path = os.path.join(directory, "pilot_study_{}.json".format(room_id))
-        
+
+    written = 0
+    for file_name, room_data in rooms:
+        room_file_path = os.path.join(directory, file_name)
+        if read_room(room_file_path) == room_data:
+            continue
         with open(room_file_path, 'w') as room_file:
             json.dump(room_data, room_file, indent=2)
-        
-        print("Created room file: {}".format(room_file_path))
+        written += 1
+    return written
+
+# Function to sort room files by name, with room numbers compared as numbers
+def natural_key(file_name):
+    stem, _, number = file_name[:-len(".json")].rpartition("_")
+    return (stem, int(number), file_name) if number.isdigit() else (file_name, -1, file_name)
+
+# Function to write the manifest of every room file in the directory
+def write_manifest(directory, manifest_path):
+    rooms = []
+    for file_name in sorted((name for name in os.listdir(directory) if name.endswith(".json")), key=natural_key):
+        room_data = read_room(os.path.join(directory, file_name)) or {}
+        rooms.append({
+            "fileName": file_name,
+            "hash": room_hash(file_name),
+            "botType": room_data.get("botType"),
+            "postName": room_data.get("postName"),
+            "duration": room_data.get("duration"),
+        })
+    # Written to a temporary file first, so the server never reads half a manifest
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        # One room per line keeps the file small and its diffs readable
+        f.write('{{"version": {}, "rooms": [\n'.format(manifest_version))
+        f.write(",\n".join(json.dumps(room) for room in rooms))
+        f.write("\n]}\n")
+    os.replace(temporary_path, manifest_path)
+    return len(rooms)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the room files of a study design and the room manifest.")
+    parser.add_argument("designs", nargs="*", default=[design_path], help="study design files")
+    parser.add_argument("--directory", default=directory)
+    parser.add_argument("--manifest", default=manifest_path)
+    parser.add_argument("--manifest-only", action="store_true",
+                        help="only rebuild the manifest, e.g. after adding a room file by hand")
+    args = parser.parse_args()
 
-# Create the room files
-create_room_files(directory, total_rooms, room_base)
+    if not args.manifest_only:
+        for path in args.designs:
+            design = load_design(path)
+            written = create_room_files(args.directory, design_rooms(design))
+            print("{}: {} rooms, {} room files written".format(path, design["rooms"], written))
+    print("Wrote {} rooms to {}".format(write_manifest(args.directory, args.manifest), args.manifest))
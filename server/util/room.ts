@@ -17,7 +17,9 @@ const roomDir = path.join(privateDir, "chatPrograms");
 export module Rooms {
 
     let rooms = {};
-    let roomSpecFiles: string[] = [];
+    // Room hash -> room file name, and the reverse
+    let roomsByHash: Map<string, string> = new Map();
+    let hashesByFileName: Map<string, string> = new Map();
 
     const registerEndRoom = (roomID, time: Date) => {
         const timetarget = time.getTime();
@@ -45,35 +47,82 @@ export module Rooms {
         }
     }
 
-    export async function getAvailableRooms(): Promise<any[]> {
-        if (!(roomSpecFiles.length > 0)) {
-            roomSpecFiles = await fs.promises.readdir(path.resolve(roomDir, "roomSpecs"));
+    // Written by roomSpecs/createRooms.py: every room file with its hash, so the
+    // rooms need not be listed and hashed on startup
+    const manifestPath = path.resolve(roomDir, "roomManifest.json");
+    let manifestMtime: number = -1;
+
+    const loadRoomIndex = async (): Promise<void> => {
+        let entries: [string, string][];
+        try {
+            const stat = await fs.promises.stat(manifestPath);
+            if (stat.mtimeMs === manifestMtime) {
+                return;
+            }
+            const manifest = JSON.parse(await fs.promises.readFile(manifestPath, 'utf-8'));
+            entries = manifest.rooms.map((room: any): [string, string] => [room.hash, room.fileName]);
+            manifestMtime = stat.mtimeMs;
+        } catch (error) {
+            if (roomsByHash.size > 0) {
+                return;
+            }
+            // Without a manifest every file in roomSpecs is listed and hashed
+            console.error(`Failed to read room manifest ${manifestPath}: ${error.message}`);
+            const roomSpecFiles: string[] = await fs.promises.readdir(path.resolve(roomDir, "roomSpecs"));
+            entries = roomSpecFiles.map((fileName: string): [string, string] => [fileNameToHash(fileName), fileName]);
+        }
+        roomsByHash = new Map(entries);
+        hashesByFileName = new Map(entries.map(([hash, fileName]): [string, string] => [fileName, hash]));
+    }
+
+    // Room files the manifest does not list (added by hand, or local test rooms) are
+    // found by listing the directory; only the files not indexed yet are hashed
+    const indexUnlistedRooms = async (): Promise<void> => {
+        const roomSpecFiles: string[] = await fs.promises.readdir(path.resolve(roomDir, "roomSpecs"));
+        for (const fileName of roomSpecFiles) {
+            if (!hashesByFileName.has(fileName)) {
+                const hash: string = fileNameToHash(fileName);
+                roomsByHash.set(hash, fileName);
+                hashesByFileName.set(fileName, hash);
+            }
         }
-        const hash_filename_map: string[][] = roomSpecFiles.map((fileName: string) => {
-            const hash: string = fileNameToHash(fileName);
-            const res: any[] = [hash, fileName];
-            return res;
-        }, []);
-        console.log(hash_filename_map);
-        return hash_filename_map;
+    }
+
+    const findRoomFile = async (roomID: string): Promise<string | undefined> => {
+        if (!roomsByHash.has(roomID)) {
+            // Not loaded yet, or the manifest was rebuilt since it was loaded
+            await loadRoomIndex();
+        }
+        if (!roomsByHash.has(roomID)) {
+            await indexUnlistedRooms();
+        }
+        return roomsByHash.get(roomID);
+    }
+
+    export async function getAvailableRooms(): Promise<any[]> {
+        await loadRoomIndex();
+        await indexUnlistedRooms();
+        return Array.from(roomsByHash.entries());
     }
 
     export async function getAssignedChatRoom(roomID: string): Promise<string> {
         console.log(`getAssignedChatRoom called with roomID: ${roomID}`); // Debugging line
-        const availableRooms = await getAvailableRooms();
-        const availableRoomMap = availableRooms.find(([hash, fileName]) => hash === roomID);
-        if (availableRoomMap) {
-            const [_, fileName] = availableRoomMap;
+        const fileName = await findRoomFile(roomID);
+        if (fileName) {
             return fileName;
         }
         throw new Error(`Room with ID ${roomID} not found`);
     }
 
     async function fileNameLookup(roomFileName: string): Promise<string> {
-        const availableRooms = await getAvailableRooms();
-        const availableRoomMap = availableRooms.find(([hash, fileName]) => fileName === roomFileName);
-        if (availableRoomMap) {
-            const [hash, _] = availableRoomMap;
+        if (!hashesByFileName.has(roomFileName)) {
+            await loadRoomIndex();
+        }
+        if (!hashesByFileName.has(roomFileName)) {
+            await indexUnlistedRooms();
+        }
+        const hash = hashesByFileName.get(roomFileName);
+        if (hash) {
             return hash;
         }
         throw new Error(`Room with filename ${roomFileName} not found`);
@@ -154,12 +203,10 @@ export module Rooms {
     };
 
     const getLatestResponseFile = async (roomID: string, version: number) => {
-        const availableRooms = await getAvailableRooms();
-        const availableRoomMap = availableRooms.find(([hash, fileName]) => hash === roomID);
-        if (!availableRoomMap) {
+        const fileName = await findRoomFile(roomID);
+        if (!fileName) {
             throw new Error(`Room with ID ${roomID} not found`);
         }
-        const [_, fileName] = availableRoomMap;
         
         const responseFiles = await fs.promises.readdir(responsesDir);
 